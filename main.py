@@ -4,7 +4,18 @@ import json
 import os
 from datetime import datetime, time, timedelta # time ถูก import แต่ไม่ได้ใช้โดยตรง อาจลบออกได้ถ้าไม่จำเป็น
 import pytz
-import traceback
+import logging
+import logging.handlers
+import queue
+import sys
+import atexit
+import asyncio
+import sqlite3
+import socket
+import threading
+import hashlib
+import heapq
+import random
 
 # --- START: Keep Alive Web Server Dependencies ---
 from flask import Flask
@@ -24,6 +35,96 @@ intents.guilds = True
 bot = commands.Bot(command_prefix='$$', intents=intents)
 TZ_BANGKOK = pytz.timezone('Asia/Bangkok')
 
+# --- Logging Configuration ---
+# LOG_LEVEL: ระดับ log หลัก (DEBUG/INFO/WARNING/ERROR)
+# LOG_MODULE_LEVELS: กำหนดระดับราย logger เช่น "pickup.panel=DEBUG,discord=INFO" (ทับค่าใน DEFAULT_LOG_MODULE_LEVELS เฉพาะตัวที่ระบุ)
+# LOG_FORMAT: "json" (ค่าเริ่มต้น) หรือ "text" สำหรับอ่านเองตอนรัน local
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+DEFAULT_LOG_MODULE_LEVELS = {'discord': 'WARNING', 'werkzeug': 'WARNING'}
+LOG_MODULE_LEVELS = os.environ.get('LOG_MODULE_LEVELS', '')
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json').lower()
+# python main.py verify-ledger พิมพ์รายงานออก stdout จึงส่ง log ไป stderr แทน ไม่ให้สองอย่างปนกัน
+RUNNING_LEDGER_CLI = __name__ == '__main__' and sys.argv[1:2] == ['verify-ledger']
+
+# Attributes every LogRecord has; anything else on a record came from `extra=` and is emitted as a field.
+_STANDARD_RECORD_ATTRS = set(logging.LogRecord('', 0, '', 0, '', (), None).__dict__) | {'message', 'asctime'}
+
+class JsonLogFormatter(logging.Formatter):
+    # Runs on the listener thread, so the Bangkok timestamp is only built here, never in the handler that logged.
+    def formatTime(self, record, datefmt=None):
+        return datetime.fromtimestamp(record.created, TZ_BANGKOK).isoformat(timespec='milliseconds')
+
+    def format(self, record):
+        payload = {
+            "ts": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _STANDARD_RECORD_ATTRS and not key.startswith('_'):
+                payload[key] = value
+        if record.exc_info:
+            payload["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            payload["exc"] = record.exc_text
+        if record.stack_info:
+            payload["stack"] = self.formatStack(record.stack_info)
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+class TextLogFormatter(logging.Formatter):
+    def formatTime(self, record, datefmt=None):
+        return datetime.fromtimestamp(record.created, TZ_BANGKOK).strftime('%Y-%m-%d %H:%M:%S %Z')
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    # The stock QueueHandler.prepare() runs the full formatter (timestamp, traceback text) on the caller's thread.
+    # We only merge msg % args here so later mutation of the args can't change the message; everything else
+    # is left for the listener thread.
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+log_queue = queue.SimpleQueue()
+log_listener = None
+
+def setup_logging():
+    global log_listener
+    if log_listener is not None:
+        return
+
+    stream_handler = logging.StreamHandler(sys.stderr if RUNNING_LEDGER_CLI else sys.stdout)
+    stream_handler.setFormatter(JsonLogFormatter() if LOG_FORMAT == 'json' else TextLogFormatter('[%(asctime)s] %(levelname)s %(name)s: %(message)s'))
+
+    root_logger = logging.getLogger()
+    root_logger.handlers.clear()
+    root_logger.addHandler(DeferredQueueHandler(log_queue))
+    root_logger.setLevel(getattr(logging, LOG_LEVEL, logging.INFO))
+
+    module_levels = dict(DEFAULT_LOG_MODULE_LEVELS)
+    for entry in LOG_MODULE_LEVELS.split(','):
+        name, sep, level = entry.strip().partition('=')
+        if not sep or not name.strip():
+            continue
+        module_levels[name.strip()] = level.strip().upper()
+    for name, level in module_levels.items():
+        logging.getLogger(name).setLevel(getattr(logging, level, logging.INFO))
+
+    log_listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    log_listener.start()
+    atexit.register(log_listener.stop) # Flush ที่ค้างอยู่ในคิวก่อนโปรเซสจบ
+
+setup_logging()
+log = logging.getLogger('pickup')
+data_log = logging.getLogger('pickup.data')
+inventory_log = logging.getLogger('pickup.inventory')
+bank_log = logging.getLogger('pickup.bank')
+ledger_log = logging.getLogger('pickup.ledger')
+ui_log = logging.getLogger('pickup.ui')
+panel_log = logging.getLogger('pickup.panel')
+task_log = logging.getLogger('pickup.tasks')
+web_log = logging.getLogger('pickup.web')
+
 # --- Inventory System Variables ---
 AVAILABLE_ITEMS = ["เงินแดง", "ไวเบรเนียม", "เกาะ", "AED", "Painkiller", "ปูน", "ไม้กระดาน", "ทองคำ", "ทองแดง", "ทับทิม", "เพชร","เหล็ก","เศษเหล็ก"]
 AVAILABLE_ITEMS.sort()
@@ -49,77 +150,407 @@ LOW_ROLES = ["สมาชิกแก๊ง", "เบิกของ"] # ตร
 
 TEAM_INVENTORY_FILE = 'team_inventory_dedicated.json'
 TEAM_BANK_FILE = 'team_bank.json'
+LEDGER_FILE = 'team_ledger.jsonl' # ประวัติธุรกรรมทั้งหมดแบบ append-only (โหมดไฟล์)
+LEDGER_CHECKPOINT_FILE = 'ledger_checkpoint.json' # จุดที่ตรวจสอบผ่านล่าสุด (โหมดไฟล์)
+LEDGER_BASE_FILE = 'ledger_base.json' # ยอดสะสม ณ entry สุดท้ายที่ถูก compact ออกไป (โหมดไฟล์)
+LEDGER_ARCHIVE_DIR = 'ledger_archive'
+SNAPSHOT_DIR = 'snapshots'
 
 CONTROL_PANEL_CHANNEL_ID = 1376171932361293994  # <<-- ตรวจสอบว่า ID นี้ถูกต้อง และบอทมีสิทธิ์ในห้องนี้
 CONTROL_PANEL_MESSAGE_ID_FILE = 'control_panel_message_id.txt'
 
+# --- Shared State Store Configuration ---
+# STATE_STORE=file (ค่าเริ่มต้น) ใช้ไฟล์ JSON แบบเดิม รันได้โปรเซสเดียว
+# STATE_STORE=sqlite ให้หลายโปรเซสใช้ฐานข้อมูล SQLite ไฟล์เดียวกัน (ต้องอยู่บนเครื่อง/ดิสก์เดียวกัน)
+STATE_STORE_MODE = os.environ.get('STATE_STORE', 'file').lower()
+STATE_DB_FILE = os.environ.get('STATE_DB_FILE', 'pickup_state.db')
+INSTANCE_ID = os.environ.get('INSTANCE_ID') or f"{socket.gethostname()}-{os.getpid()}"
+STATE_POLL_SECONDS = 2 # ความถี่ในการเช็คการเปลี่ยนแปลงจากโปรเซสอื่น
+LEADER_LEASE_SECONDS = 30 # อายุ lease ของ leader ถ้าไม่ต่ออายุภายในเวลานี้ โปรเซสอื่นจะรับช่วงต่อ
+PANEL_LEASE_NAME = 'panel_owner'
+
+# --- Scheduled Jobs Configuration ---
+# cron เป็นเวลาไทย (Asia/Bangkok): "นาที ชั่วโมง วันที่ เดือน วันในสัปดาห์ (0=อาทิตย์)" รองรับ *, */n, a-b, a-b/n, a,b
+# jitter_seconds = หน่วงแบบสุ่ม 0..n วินาที ไม่ให้งานหนักชนกันตรงนาทีเดียว งานทั้งหมดรันเฉพาะบน panel leader
+SCHEDULED_JOBS = {
+    "panel_refresh":     {"cron": "0 8 * * *",   "jitter_seconds": 0,   "enabled": True},
+    "state_snapshot":    {"cron": "0 */6 * * *", "jitter_seconds": 120, "enabled": True},
+    "daily_digest":      {"cron": "55 23 * * *", "jitter_seconds": 0,   "enabled": True},
+    "ledger_compaction": {"cron": "30 4 * * *",  "jitter_seconds": 300, "enabled": True},
+    "retention_cleanup": {"cron": "0 5 * * *",   "jitter_seconds": 600, "enabled": True},
+}
+DIGEST_CHANNEL_ID = CONTROL_PANEL_CHANNEL_ID # ห้องที่ส่งสรุปรายวัน เปลี่ยนเป็นห้องอื่นได้
+LEDGER_RETAIN_HOURS = 48 # compaction เก็บ entry ช่วงนี้ไว้ใน ledger หลักเสมอ (daily_digest อ่านจากตรงนี้)
+SNAPSHOT_RETENTION_DAYS = 14
+LEDGER_ARCHIVE_RETENTION_DAYS = 365
+STATE_CHANGES_RETENTION_HOURS = 24 # แถวใน state_changes ที่เก่ากว่านี้ทุกโปรเซสอ่านไปแล้ว
+PANEL_UPDATE_DEBOUNCE_SECONDS = 1.5 # รวมธุรกรรมที่เข้ามาติด ๆ กันเป็นการแก้ไขพาเนลครั้งเดียว
+
 # --- Data Structures ---
 team_inventory = {item: 0 for item in AVAILABLE_ITEMS}
 team_bank = {"balance": 0, "log": []}
 
+# --- Shared State Store ---
+class StoreConflict(Exception):
+    pass
+
+class SharedStateStore:
+    # Versioned key/value rows in SQLite. Every write is a compare-and-swap on the row version and appends
+    # to state_changes in the same transaction, which is what other processes poll to invalidate their caches.
+    # Each thread gets its own connection, so a writer waiting on busy_timeout for another process never blocks
+    # a reader in this process behind a shared Python lock.
+    def __init__(self, path: str, instance_id: str):
+        self.path, self.instance_id = path, instance_id
+        self._local = threading.local()
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS state_kv (key TEXT PRIMARY KEY, value TEXT, version INTEGER NOT NULL);
+            CREATE TABLE IF NOT EXISTS state_changes (seq INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT NOT NULL, version INTEGER NOT NULL, origin TEXT NOT NULL, changed_at TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS state_leases (name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL);
+            CREATE TABLE IF NOT EXISTS ledger_entries (seq INTEGER PRIMARY KEY, key TEXT NOT NULL, entry TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS ledger_checkpoint (id INTEGER PRIMARY KEY CHECK (id = 1), data TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS ledger_base (id INTEGER PRIMARY KEY CHECK (id = 1), data TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS ledger_archive (seq INTEGER PRIMARY KEY, key TEXT NOT NULL, entry TEXT NOT NULL, archived_at TEXT NOT NULL);
+        """)
+        self._last_data_version = None
+        # PRAGMA data_version is per connection, so polling always uses the same one
+        self._poll_conn = self._connect()
+        self._poll_lock = threading.Lock()
+        self.last_seen_seq = self._conn.execute("SELECT COALESCE(MAX(seq), 0) FROM state_changes").fetchone()[0]
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA busy_timeout=5000")
+        return conn
+
+    @property
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    def get(self, key: str):
+        row = self._conn.execute("SELECT value, version FROM state_kv WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None, 0
+        return (json.loads(row[0]) if row[0] is not None else None), row[1]
+
+    def compare_and_swap(self, key: str, expected_version: int, value, ledger_entries=()):
+        encoded = json.dumps(value, ensure_ascii=False) if value is not None else None
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            if expected_version == 0:
+                cur = self._conn.execute("INSERT OR IGNORE INTO state_kv (key, value, version) VALUES (?, ?, 1)", (key, encoded))
+            else:
+                cur = self._conn.execute("UPDATE state_kv SET value = ?, version = version + 1 WHERE key = ? AND version = ?", (encoded, key, expected_version))
+            if cur.rowcount != 1:
+                raise StoreConflict(f"{key} is no longer at version {expected_version}")
+            new_version = expected_version + 1
+            self._conn.execute("INSERT INTO state_changes (key, version, origin, changed_at) VALUES (?, ?, ?, ?)",
+                               (key, new_version, self.instance_id, datetime.now(TZ_BANGKOK).isoformat()))
+            self._append_ledger_in_txn(ledger_entries)
+            self._conn.execute("COMMIT")
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+        return new_version
+
+    def update(self, key: str, mutate, ledger_entries_for=None, max_attempts: int = 20):
+        # mutate(current_value) returns the new value, or None to abort without writing. Retried on conflict.
+        # ledger_entries_for(current_value, new_value), if given, builds ledger entries committed with the write.
+        for _ in range(max_attempts):
+            current, version = self.get(key)
+            new_value = mutate(current)
+            if new_value is None:
+                return None
+            ledger_entries = ledger_entries_for(current, new_value) if ledger_entries_for else ()
+            try:
+                self.compare_and_swap(key, version, new_value, ledger_entries)
+                return new_value
+            except StoreConflict:
+                continue
+        raise StoreConflict(f"Gave up updating {key} after {max_attempts} conflicting attempts")
+
+    def put(self, key: str, value):
+        return self.update(key, lambda _current: value)
+
+    def poll_changes(self):
+        # PRAGMA data_version only moves when another connection commits, so an idle poll is a single pragma.
+        with self._poll_lock:
+            data_version = self._poll_conn.execute("PRAGMA data_version").fetchone()[0]
+            if data_version == self._last_data_version:
+                return []
+            self._last_data_version = data_version
+            rows = self._poll_conn.execute("SELECT seq, key, origin FROM state_changes WHERE seq > ? ORDER BY seq", (self.last_seen_seq,)).fetchall()
+        if rows:
+            self.last_seen_seq = rows[-1][0]
+        return rows
+
+    def try_acquire_lease(self, name: str, ttl_seconds: float) -> bool:
+        now = datetime.now(pytz.utc).timestamp()
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = self._conn.execute("SELECT owner, expires_at FROM state_leases WHERE name = ?", (name,)).fetchone()
+            acquired = row is None or row[0] == self.instance_id or row[1] < now
+            if acquired:
+                self._conn.execute("INSERT OR REPLACE INTO state_leases (name, owner, expires_at) VALUES (?, ?, ?)", (name, self.instance_id, now + ttl_seconds))
+            self._conn.execute("COMMIT")
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+        return acquired
+
+    def release_lease(self, name: str):
+        self._conn.execute("DELETE FROM state_leases WHERE name = ? AND owner = ?", (name, self.instance_id))
+
+    def _append_ledger_in_txn(self, entries):
+        # Caller is inside a BEGIN IMMEDIATE transaction on this thread's connection, so reading the chain head is race-free.
+        if not entries:
+            return
+        row = self._conn.execute("SELECT seq, entry FROM ledger_entries ORDER BY seq DESC LIMIT 1").fetchone()
+        if row:
+            seq, prev_hash = row[0], json.loads(row[1])["hash"]
+        else:
+            base = self._get_ledger_base_in_txn() # ledger อาจว่างเพราะ compact ไปหมดแล้ว ต่อ chain จาก base
+            seq, prev_hash = (base["seq"], base["hash"]) if base else (0, LEDGER_GENESIS_HASH)
+        for entry in entries:
+            seq += 1
+            sealed = seal_ledger_entry(entry, seq, prev_hash)
+            self._conn.execute("INSERT INTO ledger_entries (seq, key, entry) VALUES (?, ?, ?)", (seq, sealed["key"], json.dumps(sealed, ensure_ascii=False)))
+            prev_hash = sealed["hash"]
+
+    def open_ledger(self, opening_entries_for) -> bool:
+        # Writes opening balances once, from the state as it is in the same transaction.
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            if self._conn.execute("SELECT 1 FROM ledger_entries LIMIT 1").fetchone() or self._get_ledger_base_in_txn():
+                self._conn.execute("COMMIT")
+                return False
+            self._append_ledger_in_txn(opening_entries_for(*self._read_state_in_txn()))
+            self._conn.execute("COMMIT")
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+        return True
+
+    def _read_state_in_txn(self):
+        values = dict(self._conn.execute("SELECT key, value FROM state_kv WHERE key IN ('team_inventory', 'team_bank')").fetchall())
+        inventory = normalize_inventory(json.loads(values['team_inventory']) if values.get('team_inventory') else None)
+        bank = normalize_bank(json.loads(values['team_bank']) if values.get('team_bank') else None)
+        return inventory, bank
+
+    def read_state(self):
+        # Inventory and bank from one transaction, for snapshots
+        self._conn.execute("BEGIN")
+        try:
+            return self._read_state_in_txn()
+        finally:
+            self._conn.execute("COMMIT")
+
+    @staticmethod
+    def _decode_ledger_rows(rows):
+        entries = []
+        for (raw,) in rows:
+            try:
+                entries.append(json.loads(raw))
+            except json.JSONDecodeError:
+                entries.append(None)
+        return entries
+
+    def ledger_snapshot(self, after_seq: int):
+        # Ledger tail and current state read in one transaction so they can't be torn by a concurrent write.
+        self._conn.execute("BEGIN")
+        try:
+            rows = self._conn.execute("SELECT entry FROM ledger_entries WHERE seq > ? ORDER BY seq", (after_seq,)).fetchall()
+            inventory, bank = self._read_state_in_txn()
+        finally:
+            self._conn.execute("COMMIT")
+        return self._decode_ledger_rows(rows), inventory, bank
+
+    def ledger_entries(self):
+        rows = self._conn.execute("SELECT entry FROM ledger_entries ORDER BY seq").fetchall()
+        return self._decode_ledger_rows(rows)
+
+    def _get_ledger_base_in_txn(self):
+        row = self._conn.execute("SELECT data FROM ledger_base WHERE id = 1").fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get_ledger_base(self):
+        return self._get_ledger_base_in_txn()
+
+    def compact_ledger(self, checkpoint_seq: int, cutoff: datetime):
+        # Moves verified entries older than cutoff into ledger_archive and records the new base, in one transaction.
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            base = self._get_ledger_base_in_txn() or ledger_genesis()
+            rows = self._conn.execute("SELECT entry FROM ledger_entries WHERE seq <= ? ORDER BY seq", (checkpoint_seq,)).fetchall()
+            new_base = fold_ledger_prefix(base, [(entry, None) for entry in self._decode_ledger_rows(rows)], checkpoint_seq, cutoff)
+            if new_base:
+                self._conn.execute("INSERT OR REPLACE INTO ledger_archive (seq, key, entry, archived_at) SELECT seq, key, entry, ? FROM ledger_entries WHERE seq <= ?",
+                                   (datetime.now(TZ_BANGKOK).isoformat(), new_base["seq"]))
+                self._conn.execute("DELETE FROM ledger_entries WHERE seq <= ?", (new_base["seq"],))
+                self._conn.execute("INSERT OR REPLACE INTO ledger_base (id, data) VALUES (1, ?)", (json.dumps(new_base, ensure_ascii=False),))
+            self._conn.execute("COMMIT")
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+        return (new_base["seq"] - base["seq"]) if new_base else 0
+
+    def prune(self, changes_before: datetime, archive_before: datetime):
+        changes = self._conn.execute("DELETE FROM state_changes WHERE changed_at < ? AND seq < ?", (changes_before.isoformat(), self.last_seen_seq)).rowcount
+        archived = self._conn.execute("DELETE FROM ledger_archive WHERE archived_at < ?", (archive_before.isoformat(),)).rowcount
+        return changes, archived
+
+    def get_ledger_checkpoint(self):
+        row = self._conn.execute("SELECT data FROM ledger_checkpoint WHERE id = 1").fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save_ledger_checkpoint(self, checkpoint: dict) -> bool:
+        # Never moves the checkpoint backwards: a slower verify in another process may finish after a newer one
+        # (and after a compaction that based ledger_base on it). Returns False if a newer checkpoint is already stored.
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = self._conn.execute("SELECT data FROM ledger_checkpoint WHERE id = 1").fetchone()
+            saved = row is None or json.loads(row[0])["seq"] <= checkpoint["seq"]
+            if saved:
+                self._conn.execute("INSERT OR REPLACE INTO ledger_checkpoint (id, data) VALUES (1, ?)", (json.dumps(checkpoint, ensure_ascii=False),))
+            self._conn.execute("COMMIT")
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+        return saved
+
+state_store = SharedStateStore(STATE_DB_FILE, INSTANCE_ID) if STATE_STORE_MODE == 'sqlite' else None
+state_cache_valid = False # ใช้เฉพาะโหมด sqlite: False = ต้องโหลดจาก store ใหม่ในการเรียก load_data() ครั้งถัดไป
+is_panel_leader = state_store is None # โหมดไฟล์มีโปรเซสเดียว จึงเป็นเจ้าของพาเนลเสมอ
+
+if state_store:
+    atexit.register(state_store.release_lease, PANEL_LEASE_NAME)
+
 # --- Helper Functions ---
-def log_ts():
-    return f"[{datetime.now(TZ_BANGKOK).strftime('%Y-%m-%d %H:%M:%S %Z')}]"
+def normalize_inventory(loaded_data):
+    # Ensure all AVAILABLE_ITEMS are present, initialize new items to 0
+    inventory = {item: 0 for item in AVAILABLE_ITEMS}
+    if loaded_data:
+        inventory.update({k: v for k, v in loaded_data.items() if k in AVAILABLE_ITEMS}) # Only load known items
+    return inventory
+
+def normalize_bank(loaded_data):
+    bank = dict(loaded_data) if loaded_data else {}
+    if "balance" not in bank: bank["balance"] = 0
+    if "log" not in bank: bank["log"] = []
+    return bank
 
 def load_data():
-    global team_inventory, team_bank
+    global team_inventory, team_bank, state_cache_valid
+    if state_store:
+        if state_cache_valid:
+            return
+        team_inventory = normalize_inventory(state_store.get('team_inventory')[0])
+        team_bank = normalize_bank(state_store.get('team_bank')[0])
+        state_cache_valid = True
+        return
     # Inventory
     try:
         with open(TEAM_INVENTORY_FILE, 'r', encoding='utf-8') as f:
-            loaded_data = json.load(f)
-        # Ensure all AVAILABLE_ITEMS are present, initialize new items to 0
-        temp_inventory = {item: 0 for item in AVAILABLE_ITEMS}
-        temp_inventory.update({k: v for k, v in loaded_data.items() if k in AVAILABLE_ITEMS}) # Only load known items
-        team_inventory = temp_inventory
+            team_inventory = normalize_inventory(json.load(f))
     except (FileNotFoundError, json.JSONDecodeError) as e:
-        print(f"{log_ts()} WARNING: {TEAM_INVENTORY_FILE} not found or invalid ({e}). Initializing.")
+        data_log.warning("%s not found or invalid (%s). Initializing.", TEAM_INVENTORY_FILE, e)
         team_inventory = {item: 0 for item in AVAILABLE_ITEMS}
     # Bank
     try:
         with open(TEAM_BANK_FILE, 'r', encoding='utf-8') as f:
-            team_bank = json.load(f)
-            if "balance" not in team_bank: team_bank["balance"] = 0
-            if "log" not in team_bank: team_bank["log"] = []
+            team_bank = normalize_bank(json.load(f))
     except (FileNotFoundError, json.JSONDecodeError) as e:
-        print(f"{log_ts()} WARNING: {TEAM_BANK_FILE} not found or invalid ({e}). Initializing.")
+        data_log.warning("%s not found or invalid (%s). Initializing.", TEAM_BANK_FILE, e)
         team_bank = {"balance": 0, "log": []}
     # No need for finally save here, save when changes occur
 
-def save_inventory_to_file():
+async def load_data_async():
+    # โหมด sqlite อ่านจาก store ใน thread ไม่ให้ event loop ค้างถ้าฐานข้อมูลถูกโปรเซสอื่นล็อกอยู่
+    if state_store:
+        await asyncio.to_thread(load_data)
+    else:
+        load_data()
+
+def seed_state_store_from_files():
+    # First start in sqlite mode: carry over the existing JSON files. CAS at version 0 means only one process wins.
+    for key, path, normalize in (('team_inventory', TEAM_INVENTORY_FILE, normalize_inventory), ('team_bank', TEAM_BANK_FILE, normalize_bank)):
+        if state_store.get(key)[1] != 0:
+            continue
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                value = normalize(json.load(f))
+        except (FileNotFoundError, json.JSONDecodeError):
+            value = normalize(None)
+        try:
+            state_store.compare_and_swap(key, 0, value)
+            data_log.info("Seeded shared state key %s from %s", key, path)
+        except StoreConflict:
+            pass # โปรเซสอื่น seed ไปแล้ว
+
+def write_json_atomic(path: str, data):
+    # เขียนลงไฟล์ชั่วคราวแล้วค่อย os.replace ถ้าโปรเซสตายกลางคัน ไฟล์เดิมจะยังอยู่ครบ ไม่ใช่ไฟล์ที่เขียนได้ครึ่งเดียว
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=4)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def save_inventory_to_file(inventory: dict):
     try:
-        with open(TEAM_INVENTORY_FILE, 'w', encoding='utf-8') as f:
-            json.dump(team_inventory, f, ensure_ascii=False, indent=4)
+        write_json_atomic(TEAM_INVENTORY_FILE, inventory)
     except Exception as e:
-        print(f"{log_ts()} ERROR saving inventory: {e}")
+        data_log.error("Error saving inventory: %s", e)
 
-def save_bank_data():
+def save_bank_data(bank: dict):
     try:
-        with open(TEAM_BANK_FILE, 'w', encoding='utf-8') as f:
-            json.dump(team_bank, f, ensure_ascii=False, indent=4)
+        write_json_atomic(TEAM_BANK_FILE, bank)
     except Exception as e:
-        print(f"{log_ts()} ERROR saving bank data: {e}")
-
-async def update_inventory_action(item_name: str, quantity_change: int, action: str):
-    if item_name not in AVAILABLE_ITEMS: # Check against defined items
-        print(f"{log_ts()} Attempted action on unknown item: {item_name}")
-        return False # Or handle as an error appropriate for your logic
-
-    current_quantity = team_inventory.get(item_name, 0) # Use .get for safety
+        data_log.error("Error saving bank data: %s", e)
 
+def apply_inventory_change(inventory: dict, item_name: str, quantity_change: int, action: str):
+    # Returns the updated inventory, or None if the action can't be applied
+    current_quantity = inventory.get(item_name, 0) # Use .get for safety
     if action == "deposit":
-        team_inventory[item_name] = current_quantity + quantity_change
+        new_quantity = current_quantity + quantity_change
     elif action == "withdraw":
         if current_quantity < quantity_change:
-            return False # Not enough items
-        team_inventory[item_name] = current_quantity - quantity_change
+            return None # Not enough items
+        new_quantity = current_quantity - quantity_change
     else:
-        return False # Unknown action
-    save_inventory_to_file()
+        return None # Unknown action
+    return {**inventory, item_name: new_quantity}
+
+async def update_inventory_action(item_name: str, quantity_change: int, action: str, user: discord.User = None, reason: str = ""):
+    global team_inventory
+    if item_name not in AVAILABLE_ITEMS: # Check against defined items
+        inventory_log.warning("Attempted action on unknown item: %s", item_name, extra={"item": item_name, "action": action})
+        return False # Or handle as an error appropriate for your logic
+
+    delta = quantity_change if action == "deposit" else -quantity_change
+    ledger_entries_for = lambda _old, new: [make_ledger_entry(item_name, action, delta, new[item_name], user, reason)]
+    if state_store:
+        new_inventory = await asyncio.to_thread(state_store.update, 'team_inventory',
+                                                lambda current: apply_inventory_change(normalize_inventory(current), item_name, quantity_change, action),
+                                                ledger_entries_for)
+        if new_inventory is None:
+            return False
+        team_inventory = new_inventory
+        return True
+    async with ledger_file_lock:
+        new_inventory = apply_inventory_change(team_inventory, item_name, quantity_change, action)
+        if new_inventory is None:
+            return False
+        await asyncio.to_thread(write_file_transaction, ledger_entries_for(team_inventory, new_inventory), save_inventory_to_file, new_inventory)
+        team_inventory = new_inventory
     return True
 
 async def send_item_log(target_channel_obj: discord.TextChannel, item_name: str, quantity: int, action: str, success: bool, reason: str, user: discord.User):
     if not target_channel_obj:
-        print(f"{log_ts()} ERROR: Item log target_channel_obj is None. User: {user.name}, Item: {item_name}")
+        inventory_log.error("Item log target_channel_obj is None. User: %s, Item: %s", user.name, item_name)
         return
 
     action_thai = "ฝาก" if action == "deposit" else "เบิก"
@@ -142,20 +573,20 @@ async def send_item_log(target_channel_obj: discord.TextChannel, item_name: str,
     try:
         await target_channel_obj.send(embed=embed)
     except Exception as e:
-        print(f"{log_ts()} ERROR sending item log: {e}")
+        inventory_log.error("Error sending item log: %s", e)
 
 
-async def update_bank_action(amount: int, action: str, user: discord.User, reason: str):
-    global team_bank
-    balance_before = team_bank["balance"]
+def apply_bank_change(bank: dict, amount: int, action: str, user: discord.User, reason: str):
+    # Returns the updated bank state, or None if the action can't be applied
+    balance_before = bank["balance"]
     if action == "deposit":
-        team_bank["balance"] += amount
+        balance_after = balance_before + amount
     elif action == "withdraw":
-        if team_bank["balance"] < amount:
-            return False
-        team_bank["balance"] -= amount
+        if balance_before < amount:
+            return None
+        balance_after = balance_before - amount
     else:
-        return False
+        return None
     log_entry = {
         "timestamp": datetime.now(TZ_BANGKOK).isoformat(),
         "user_id": user.id,
@@ -164,16 +595,33 @@ async def update_bank_action(amount: int, action: str, user: discord.User, reaso
         "amount": amount,
         "reason": reason,
         "balance_before": balance_before,
-        "balance_after": team_bank["balance"]
+        "balance_after": balance_after
     }
-    team_bank["log"].append(log_entry)
-    team_bank["log"] = team_bank["log"][-100:] # Keep only last 100 logs
-    save_bank_data()
+    return {**bank, "balance": balance_after, "log": (bank["log"] + [log_entry])[-100:]} # Keep only last 100 logs
+
+async def update_bank_action(amount: int, action: str, user: discord.User, reason: str):
+    global team_bank
+    delta = amount if action == "deposit" else -amount
+    ledger_entries_for = lambda _old, new: [make_ledger_entry(BANK_LEDGER_KEY, action, delta, new["balance"], user, reason)]
+    if state_store:
+        new_bank = await asyncio.to_thread(state_store.update, 'team_bank',
+                                           lambda current: apply_bank_change(normalize_bank(current), amount, action, user, reason),
+                                           ledger_entries_for)
+        if new_bank is None:
+            return False
+        team_bank = new_bank
+        return True
+    async with ledger_file_lock:
+        new_bank = apply_bank_change(team_bank, amount, action, user, reason)
+        if new_bank is None:
+            return False
+        await asyncio.to_thread(write_file_transaction, ledger_entries_for(team_bank, new_bank), save_bank_data, new_bank)
+        team_bank = new_bank
     return True
 
 async def send_bank_log(target_channel_obj: discord.TextChannel, amount: int, action: str, success: bool, reason: str, user: discord.User):
     if not target_channel_obj:
-        print(f"{log_ts()} ERROR: Bank log target_channel_obj is None. User: {user.name}, Amount: {amount}")
+        bank_log.error("Bank log target_channel_obj is None. User: %s, Amount: %s", user.name, amount)
         return
 
     action_thai = "ฝาก" if action == "deposit" else "ถอน"
@@ -192,7 +640,347 @@ async def send_bank_log(target_channel_obj: discord.TextChannel, amount: int, ac
     try:
         await target_channel_obj.send(embed=embed)
     except Exception as e:
-        print(f"{log_ts()} ERROR sending bank log: {e}")
+        bank_log.error("Error sending bank log: %s", e)
+
+# --- Ledger Integrity ---
+# ทุกธุรกรรมถูกบันทึกเป็น entry ที่ผูก hash กับ entry ก่อนหน้า (hash chain)
+# checkpoint เก็บจุดที่ตรวจผ่านล่าสุด + ยอดสะสมและ checksum รายไอเทม การตรวจครั้งถัดไปจึงอ่านแค่ entry ที่ต่อจาก checkpoint
+# base คือ checkpoint ของ entry สุดท้ายที่ถูก compact ย้ายไป archive แล้ว การตรวจแบบ full จะเริ่มจาก base แทน genesis
+BANK_LEDGER_KEY = 'bank.balance'
+LEDGER_GENESIS_HASH = '0' * 64
+
+ledger_file_head = None # {"seq", "hash"} ของ entry สุดท้ายในไฟล์ (โหมดไฟล์) โหลดครั้งแรกที่ต้องใช้
+ledger_file_lock = asyncio.Lock() # โหมดไฟล์: ถือไว้ตลอดการเขียน ledger + state และระหว่างตรวจ/compact ใน thread
+
+def make_ledger_entry(key: str, action: str, delta: int, after: int, user: discord.User = None, reason: str = ""):
+    return {
+        "ts": datetime.now(TZ_BANGKOK).isoformat(),
+        "key": key,
+        "action": action,
+        "delta": delta,
+        "after": after,
+        "user_id": user.id if user else None,
+        "user_name": user.name if user else None,
+        "reason": reason,
+    }
+
+def compute_ledger_hash(entry: dict) -> str:
+    body = {k: v for k, v in entry.items() if k != "hash"}
+    return hashlib.sha256(json.dumps(body, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+def seal_ledger_entry(entry: dict, seq: int, prev_hash: str) -> dict:
+    sealed = {**entry, "seq": seq, "prev_hash": prev_hash}
+    sealed["hash"] = compute_ledger_hash(sealed)
+    return sealed
+
+def ledger_genesis():
+    return {"seq": 0, "hash": LEDGER_GENESIS_HASH, "offset": 0, "totals": {}, "checksums": {}}
+
+def ledger_entry_links(entry, seq: int, prev_hash: str) -> bool:
+    # True if entry is intact and is the next link after (seq, prev_hash)
+    return entry is not None and entry.get("seq") == seq + 1 and entry.get("prev_hash") == prev_hash and compute_ledger_hash(entry) == entry.get("hash")
+
+def fold_ledger_entry(totals: dict, checksums: dict, entry: dict):
+    key = entry["key"]
+    totals[key] = totals.get(key, 0) + entry["delta"]
+    # checksum รายไอเทมใช้แค่เนื้อหาของ entry เอง (ไม่รวม seq/hash ที่ผูกกับ entry อื่น) เพื่อให้ชี้ได้ว่าไอเทมไหนถูกแก้ย้อนหลัง
+    content = json.dumps({k: v for k, v in entry.items() if k not in ("seq", "prev_hash", "hash")}, sort_keys=True, ensure_ascii=False)
+    checksums[key] = hashlib.sha256((checksums.get(key, "") + content).encode('utf-8')).hexdigest()
+
+def fold_ledger_prefix(base: dict, entries, stop_seq: int, cutoff: datetime):
+    """Replay entries from base up to stop_seq, stopping at the first one newer than cutoff. Returns the new base or None."""
+    totals, checksums = dict(base["totals"]), dict(base["checksums"])
+    seq, prev_hash, offset = base["seq"], base["hash"], base.get("offset", 0)
+    for entry, entry_offset in entries:
+        if not ledger_entry_links(entry, seq, prev_hash):
+            raise ValueError(f"Ledger chain broken at seq {seq + 1}; refusing to compact")
+        if entry["seq"] > stop_seq or datetime.fromisoformat(entry["ts"]) >= cutoff:
+            break
+        fold_ledger_entry(totals, checksums, entry)
+        seq, prev_hash = entry["seq"], entry["hash"]
+        if entry_offset is not None:
+            offset = entry_offset
+    if seq == base["seq"]:
+        return None
+    return {"seq": seq, "hash": prev_hash, "offset": offset, "totals": totals, "checksums": checksums, "compacted_at": datetime.now(TZ_BANGKOK).isoformat()}
+
+def opening_ledger_entries(inventory: dict, bank: dict):
+    # ยอดยกมาตอนเริ่มใช้ ledger ครั้งแรก เพื่อให้ยอดสะสมตรงกับ state ที่มีอยู่แล้ว
+    entries = [make_ledger_entry(item, "opening", qty, qty) for item, qty in inventory.items() if qty]
+    if bank.get("balance"):
+        entries.append(make_ledger_entry(BANK_LEDGER_KEY, "opening", bank["balance"], bank["balance"]))
+    return entries
+
+def load_ledger_file_head():
+    global ledger_file_head
+    base = load_ledger_base() or ledger_genesis() # ไฟล์ว่างหลัง compact ต้องต่อ chain จาก base
+    ledger_file_head = {"seq": base["seq"], "hash": base["hash"]}
+    if not os.path.exists(LEDGER_FILE):
+        return ledger_file_head
+    with open(LEDGER_FILE, 'rb+') as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        f.seek(max(0, size - 65536))
+        tail = f.read()
+        if tail and not tail.endswith(b"\n"):
+            # บรรทัดสุดท้ายเขียนไม่จบ (โปรเซสตายระหว่าง append) ตัดทิ้ง entry นั้นไม่เคย commit
+            cut = tail.rfind(b"\n") + 1
+            f.truncate(size - len(tail) + cut)
+            ledger_log.warning("Truncated %s bytes of partial ledger entry at end of %s", len(tail) - cut, LEDGER_FILE)
+            tail = tail[:cut]
+    for line in reversed(tail.splitlines()):
+        try:
+            last = json.loads(line.decode('utf-8'))
+            ledger_file_head = {"seq": last["seq"], "hash": last["hash"]}
+            break
+        except (UnicodeDecodeError, json.JSONDecodeError, KeyError):
+            continue
+    return ledger_file_head
+
+def append_ledger_entries_to_file(entries):
+    # Raises if the entries can't be made durable; callers must not save state in that case (write-ahead)
+    global ledger_file_head
+    if not entries:
+        return
+    try:
+        head = ledger_file_head or load_ledger_file_head()
+        seq, prev_hash = head["seq"], head["hash"]
+        lines = []
+        for entry in entries:
+            seq += 1
+            sealed = seal_ledger_entry(entry, seq, prev_hash)
+            lines.append(json.dumps(sealed, ensure_ascii=False))
+            prev_hash = sealed["hash"]
+        with open(LEDGER_FILE, 'a', encoding='utf-8') as f:
+            f.write("\n".join(lines) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        ledger_file_head = {"seq": seq, "hash": prev_hash}
+    except Exception as e:
+        ledger_file_head = None # อาจมีบรรทัดที่เขียนไม่จบค้างอยู่ ให้โหลดหัว chain ใหม่ (และตัดบรรทัดนั้นทิ้ง) ครั้งถัดไป
+        ledger_log.error("Error appending to ledger: %s", e)
+        raise
+
+def write_file_transaction(entries, save_state, state: dict):
+    # Write-ahead: ledger ก่อน state ถ้า append ไม่สำเร็จจะ raise ออกไปก่อนแตะไฟล์ state (เรียกใน thread โดยถือ ledger_file_lock)
+    append_ledger_entries_to_file(entries)
+    save_state(state)
+
+def ensure_ledger_opened():
+    try:
+        if state_store:
+            if state_store.open_ledger(opening_ledger_entries):
+                ledger_log.info("Ledger opened with current balances.")
+        elif (ledger_file_head or load_ledger_file_head())["seq"] == 0:
+            inventory, bank = read_persisted_state()
+            append_ledger_entries_to_file(opening_ledger_entries(inventory, bank))
+            ledger_log.info("Ledger opened with current balances in %s.", LEDGER_FILE)
+    except Exception as e:
+        ledger_log.error("Could not open ledger, will retry on next start: %s", e)
+
+def read_persisted_state():
+    # อ่านจากไฟล์ตรง ๆ ไม่แตะตัวแปร global เพื่อให้ตรวจกับสิ่งที่อยู่บนดิสก์จริง
+    state = []
+    for path, normalize in ((TEAM_INVENTORY_FILE, normalize_inventory), (TEAM_BANK_FILE, normalize_bank)):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                state.append(normalize(json.load(f)))
+        except (FileNotFoundError, json.JSONDecodeError):
+            state.append(normalize(None))
+    return state[0], state[1]
+
+def load_ledger_checkpoint():
+    if state_store:
+        return state_store.get_ledger_checkpoint()
+    try:
+        with open(LEDGER_CHECKPOINT_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+def save_ledger_checkpoint(checkpoint: dict):
+    if state_store:
+        state_store.save_ledger_checkpoint(checkpoint)
+    else:
+        write_json_atomic(LEDGER_CHECKPOINT_FILE, checkpoint)
+
+def load_ledger_base():
+    if state_store:
+        return state_store.get_ledger_base()
+    try:
+        with open(LEDGER_BASE_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+def read_ledger_file(offset: int = 0, after_seq: int = 0):
+    # [(entry or None if unreadable, byte offset after it)] from offset, skipping entries at or before after_seq
+    entries = []
+    if not os.path.exists(LEDGER_FILE):
+        return entries
+    with open(LEDGER_FILE, 'rb') as f:
+        f.seek(offset)
+        for line in iter(f.readline, b""):
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line.decode('utf-8'))
+            except (UnicodeDecodeError, json.JSONDecodeError):
+                entry = None
+            if entry is not None and entry.get("seq", 0) <= after_seq:
+                continue
+            entries.append((entry, f.tell()))
+    return entries
+
+def read_ledger_since(checkpoint: dict):
+    # Returns ([(entry or None if unreadable, byte offset after it)], inventory, bank)
+    if state_store:
+        entries, inventory, bank = state_store.ledger_snapshot(checkpoint["seq"])
+        return [(entry, None) for entry in entries], inventory, bank
+    inventory, bank = read_persisted_state()
+    offset = checkpoint.get("offset", 0)
+    if offset and os.path.exists(LEDGER_FILE) and os.path.getsize(LEDGER_FILE) < offset:
+        offset = 0 # ไฟล์สั้นกว่า offset (โปรเซสตายระหว่าง compaction) อ่านใหม่ทั้งไฟล์แล้วกรองด้วย seq
+    entries = read_ledger_file(offset, checkpoint["seq"])
+    if offset and entries and (entries[0][0] is None or entries[0][0].get("seq") != checkpoint["seq"] + 1):
+        entries = read_ledger_file(0, checkpoint["seq"]) # offset ไม่ตรงขอบ entry (อาจตกกลางบรรทัด) ด้วยเหตุผลเดียวกัน
+    return entries, inventory, bank
+
+def read_ledger_entries_since(since: datetime):
+    # Entries still in the active ledger (at least LEDGER_RETAIN_HOURS) with ts >= since
+    entries = state_store.ledger_entries() if state_store else [entry for entry, _offset in read_ledger_file()]
+    return [entry for entry in entries if entry and datetime.fromisoformat(entry["ts"]) >= since]
+
+def archive_ledger_file_prefix(base: dict, checkpoint: dict, cutoff: datetime):
+    # Heavy part of file compaction, safe off the event loop: it only reads bytes before the checkpoint,
+    # and appends only ever happen after EOF.
+    new_base = fold_ledger_prefix(base, read_ledger_file(0, base["seq"]), checkpoint["seq"], cutoff)
+    if not new_base:
+        return None
+    os.makedirs(LEDGER_ARCHIVE_DIR, exist_ok=True)
+    archive_path = os.path.join(LEDGER_ARCHIVE_DIR, f"ledger-{base['seq'] + 1:010d}-{new_base['seq']:010d}.jsonl")
+    with open(LEDGER_FILE, 'rb') as src, open(f"{archive_path}.tmp", 'wb') as dst:
+        dst.write(src.read(new_base["offset"]))
+        dst.flush()
+        os.fsync(dst.fileno())
+    os.replace(f"{archive_path}.tmp", archive_path)
+    return new_base
+
+def swap_compacted_ledger_file(new_base: dict):
+    # Caller must hold ledger_file_lock, so no append can land between read and replace.
+    global ledger_file_head
+    checkpoint = load_ledger_checkpoint()
+    with open(LEDGER_FILE, 'rb') as f:
+        f.seek(new_base["offset"])
+        remaining = f.read()
+    with open(f"{LEDGER_FILE}.tmp", 'wb') as f:
+        f.write(remaining)
+        f.flush()
+        os.fsync(f.fileno())
+    write_json_atomic(LEDGER_BASE_FILE, {**new_base, "offset": 0})
+    os.replace(f"{LEDGER_FILE}.tmp", LEDGER_FILE)
+    save_ledger_checkpoint({**checkpoint, "offset": checkpoint["offset"] - new_base["offset"]})
+    ledger_file_head = None # โหลดใหม่ครั้งถัดไปที่ append
+
+def verify_ledger(full: bool = False):
+    """Check current state against the ledger, starting from the last verified checkpoint (or genesis if full).
+
+    A full run also compares the replayed per-item checksums with the stored checkpoint once it reaches that seq,
+    so history rewritten behind the checkpoint is reported even if the chain was re-hashed consistently.
+    """
+    verified = load_ledger_checkpoint()
+    checkpoint = None if full else verified
+    if not checkpoint:
+        checkpoint = load_ledger_base() or ledger_genesis()
+    if not full or (verified and verified["seq"] <= checkpoint["seq"]):
+        verified = None # ไม่มีอะไรให้เทียบ: เริ่มจาก checkpoint เอง หรือ checkpoint ถูก compact ไปแล้ว
+    entries, inventory, bank = read_ledger_since(checkpoint)
+
+    totals, checksums = dict(checkpoint["totals"]), dict(checkpoint["checksums"])
+    head_seq, head_hash, head_offset = checkpoint["seq"], checkpoint["hash"], checkpoint.get("offset", 0)
+    first_drift, first_touch, last_touch = {}, {}, {}
+    chain_break = None
+    divergences = []
+    actual = {**inventory, BANK_LEDGER_KEY: bank["balance"]}
+
+    def compare_with_verified(removed: bool):
+        for key in sorted(set(verified["checksums"]) | set(checksums)):
+            if verified["checksums"].get(key) == checksums.get(key):
+                continue
+            # ธุรกรรมที่ผิดต้องเป็นหนึ่งใน entry ของ key นี้ที่ replay ได้ หรือ entry ที่หายไปหลังหัว ledger
+            from_seq = first_touch.get(key, head_seq + 1 if removed else checkpoint["seq"] + 1)
+            if removed:
+                to_seq, reason = verified["seq"], "checksum differs from the verified checkpoint, which is past the end of the ledger (entries removed)"
+            else:
+                to_seq, reason = last_touch.get(key, verified["seq"]), "history rewritten: checksum differs from the verified checkpoint"
+            divergences.append({"key": key, "expected": totals.get(key, 0), "actual": actual.get(key, 0), "checkpoint_total": verified["totals"].get(key, 0),
+                                "from_seq": from_seq, "to_seq": to_seq, "reason": reason})
+
+    for entry, offset in entries:
+        if not ledger_entry_links(entry, head_seq, head_hash):
+            chain_break = {"seq": head_seq + 1, "key": entry.get("key") if entry else None}
+            break
+        key = entry["key"]
+        fold_ledger_entry(totals, checksums, entry)
+        if entry["after"] != totals[key]:
+            first_drift.setdefault(key, entry["seq"])
+        first_touch.setdefault(key, entry["seq"])
+        last_touch[key] = entry["seq"]
+        head_seq, head_hash = entry["seq"], entry["hash"]
+        if offset is not None:
+            head_offset = offset
+        if verified and head_seq == verified["seq"]:
+            compare_with_verified(removed=False)
+            verified = None
+    if verified and chain_break is None:
+        compare_with_verified(removed=True)
+
+    for key in sorted(set(actual) | set(totals)):
+        expected_value, actual_value = totals.get(key, 0), actual.get(key, 0)
+        if key in first_drift:
+            divergences.append({"key": key, "expected": expected_value, "actual": actual_value, "from_seq": first_drift[key], "to_seq": last_touch[key],
+                                "reason": "ledger entry 'after' disagrees with the running total"})
+        elif expected_value != actual_value and chain_break is None:
+            # state ไม่ตรงกับยอดสะสม: ผิดพลาดตั้งแต่ entry ล่าสุดของ key นี้ (หรือ checkpoint ถ้าไม่มี) จนถึงหัว ledger
+            divergences.append({"key": key, "expected": expected_value, "actual": actual_value, "from_seq": last_touch.get(key, checkpoint["seq"]), "to_seq": head_seq,
+                                "reason": "state differs from ledger total"})
+
+    result = {
+        "ok": not divergences and chain_break is None,
+        "from_seq": checkpoint["seq"],
+        "to_seq": head_seq,
+        "entries_checked": head_seq - checkpoint["seq"],
+        "divergences": divergences,
+        "chain_break": chain_break,
+    }
+    if result["ok"]:
+        save_ledger_checkpoint({"seq": head_seq, "hash": head_hash, "offset": head_offset, "totals": totals, "checksums": checksums,
+                                "verified_at": datetime.now(TZ_BANGKOK).isoformat()})
+        ledger_log.info("Ledger verified up to seq %s (%s new entries).", head_seq, result["entries_checked"])
+    else:
+        ledger_log.error("Ledger verification failed: %s divergence(s), chain_break=%s", len(divergences), chain_break, extra={"divergences": divergences})
+    return result
+
+async def verify_ledger_async(full: bool = False):
+    # โหมด sqlite อ่านเป็น snapshot เดียวอยู่แล้ว โหมดไฟล์ถือ ledger_file_lock ไว้ไม่ให้มีธุรกรรมแทรกระหว่างอ่านใน thread
+    if state_store:
+        return await asyncio.to_thread(verify_ledger, full)
+    async with ledger_file_lock:
+        return await asyncio.to_thread(verify_ledger, full)
+
+def format_ledger_report(result: dict):
+    if result["entries_checked"]:
+        lines = [f"Ledger entries {result['from_seq'] + 1}..{result['to_seq']} checked ({result['entries_checked']} new)."]
+    else:
+        lines = [f"No new ledger entries since seq {result['from_seq']}."]
+    if result["chain_break"]:
+        lines.append(f"HASH CHAIN BROKEN at seq {result['chain_break']['seq']} (key: {result['chain_break']['key']}); entries after it were not trusted.")
+    for d in result["divergences"]:
+        checkpoint_total = f" checkpoint={d['checkpoint_total']}" if "checkpoint_total" in d else ""
+        lines.append(f"DIVERGENCE {d['key']}: ledger={d['expected']} state={d['actual']}{checkpoint_total} tx {d['from_seq']}..{d['to_seq']} ({d['reason']})")
+    if result["ok"]:
+        lines.append("OK: state matches ledger. Checkpoint advanced.")
+    return lines
 
 # --- UI Classes ---
 # (QuantityReasonModal, ItemSelectForTransaction, EphemeralItemSelectView, BankTransactionModal, PersistentInventoryView - โค้ดเหมือนเดิม แนะนำให้ตรวจสอบ logic การอนุญาต)
@@ -224,17 +1012,17 @@ class QuantityReasonModal(discord.ui.Modal):
             await interaction.response.send_message(f"🚫 ไม่มีสิทธิ์เบิกของ! (ต้องมี Role: {', '.join(LEADER_ROLES)})", ephemeral=True); return
 
         await interaction.response.defer(ephemeral=True, thinking=True)
-        success = await update_inventory_action(self.item_name, quantity, self.action_type)
+        success = await update_inventory_action(self.item_name, quantity, self.action_type, interaction.user, reason or "")
         await send_item_log(self.original_channel, self.item_name, quantity, self.action_type, success, reason or "N/A", interaction.user)
         await interaction.followup.send(f"ทำรายการสำเร็จ!" if success else "ทำรายการไม่สำเร็จ (ของอาจไม่พอ หรือชื่อไอเทมผิด)", ephemeral=True)
-        await setup_inventory_control_panel() # Make sure this function is robust
+        schedule_panel_update() # อัปเดตพาเนลเบื้องหลัง ไม่ให้ผู้ใช้ต้องรอ
 
     async def on_error(self, interaction: discord.Interaction, error: Exception):
-        print(f"{log_ts()} Error in QuantityReasonModal: {error}"); traceback.print_exc()
+        ui_log.error("Error in QuantityReasonModal: %s", error, exc_info=error)
         try:
             if not interaction.response.is_done(): await interaction.response.send_message("เกิดข้อผิดพลาดในการดำเนินการ Modal", ephemeral=True)
             else: await interaction.followup.send("เกิดข้อผิดพลาดในการดำเนินการ Modal", ephemeral=True)
-        except Exception as e_resp: print(f"{log_ts()} Error sending error response in QRModal: {e_resp}")
+        except Exception as e_resp: ui_log.error("Error sending error response in QRModal: %s", e_resp)
 
 
 class ItemSelectForTransaction(discord.ui.Select):
@@ -259,9 +1047,9 @@ class ItemSelectForTransaction(discord.ui.Select):
             # Edit the original ephemeral message that sent the select menu
             await interaction.edit_message(content=f"กำลังดำเนินการกับ **{selected_item}**... กรุณากรอกข้อมูลในหน้าต่างที่เด้งขึ้นมา", view=None)
         except discord.NotFound:
-            print(f"{log_ts()} WARN: Ephemeral msg for item select might have been dismissed by user or timed out before modal submission.")
+            ui_log.warning("Ephemeral msg for item select might have been dismissed by user or timed out before modal submission.")
         except Exception as e:
-            print(f"{log_ts()} Error editing item select message: {e}")
+            ui_log.error("Error editing item select message: %s", e)
 
 
 class EphemeralItemSelectView(discord.ui.View):
@@ -282,9 +1070,9 @@ class EphemeralItemSelectView(discord.ui.View):
             try:
                 await self.message.edit(content="หมดเวลาเลือกไอเทมแล้ว", view=None)
             except discord.NotFound:
-                print(f"{log_ts()} EphemeralItemSelectView: Message already deleted or not found on timeout.")
+                ui_log.info("EphemeralItemSelectView: Message already deleted or not found on timeout.")
             except Exception as e:
-                print(f"{log_ts()} Error on EphemeralItemSelectView timeout trying to edit message: {e}")
+                ui_log.error("Error on EphemeralItemSelectView timeout trying to edit message: %s", e)
         # For truly ephemeral messages, there might not be a message to edit if interaction.response.send_message was used
         # with ephemeral=True directly for the view. Components will just disable.
 
@@ -317,14 +1105,14 @@ class BankTransactionModal(discord.ui.Modal):
         success = await update_bank_action(amount, self.action_type, interaction.user, reason)
         await send_bank_log(self.original_channel, amount, self.action_type, success, reason, interaction.user)
         await interaction.followup.send("ทำรายการสำเร็จ!" if success else "ทำรายการไม่สำเร็จ (เงินอาจไม่พอ)", ephemeral=True)
-        await setup_inventory_control_panel()
+        schedule_panel_update()
 
     async def on_error(self, interaction: discord.Interaction, error: Exception):
-        print(f"{log_ts()} Error in BankTransactionModal: {error}"); traceback.print_exc()
+        ui_log.error("Error in BankTransactionModal: %s", error, exc_info=error)
         try:
             if not interaction.response.is_done(): await interaction.response.send_message("เกิดข้อผิดพลาดในการดำเนินการ Modal", ephemeral=True)
             else: await interaction.followup.send("เกิดข้อผิดพลาดในการดำเนินการ Modal", ephemeral=True)
-        except Exception as e_resp: print(f"{log_ts()} Error sending error response in BankModal: {e_resp}")
+        except Exception as e_resp: ui_log.error("Error sending error response in BankModal: %s", e_resp)
 
 class PersistentInventoryView(discord.ui.View):
     def __init__(self):
@@ -355,7 +1143,7 @@ class PersistentInventoryView(discord.ui.View):
             # Get the message object for the ephemeral response to potentially edit it on timeout
             view.message = await interaction.original_response()
         except discord.HTTPException:
-            print(f"{log_ts()} Could not get original response for ephemeral item select view. Timeout edit might not work.")
+            ui_log.warning("Could not get original response for ephemeral item select view. Timeout edit might not work.")
 
 
     @discord.ui.button(label="📥 ฝากของ", style=discord.ButtonStyle.green, custom_id="persistent_deposit_item_v2")
@@ -402,7 +1190,7 @@ class PersistentInventoryView(discord.ui.View):
 
 # --- Embed Creation ---
 def create_control_panel_embed():
-    load_data() # Load latest data before creating embed
+    # ผู้เรียกต้อง await load_data_async() ก่อน เพื่อให้ได้ข้อมูลล่าสุด
     embed = discord.Embed(title="📦 คลังกลางทีม 1M X 32Bit 📦", description="คลิกปุ่มด้านล่างเพื่อดำเนินการ", color=discord.Color.blue()) # Changed color
     # Displaying items: show all items with their quantities, even if 0, or only > 0?
     # For this example, show all defined items.
@@ -439,140 +1227,463 @@ def create_control_panel_embed():
     return embed
 
 # --- Control Panel Setup ---
-def get_control_panel_message_id():
+async def get_control_panel_message_id():
+    if state_store:
+        return (await asyncio.to_thread(state_store.get, 'control_panel_message_id'))[0] or None # 0 = ล้างค่าแล้ว
     try:
         with open(CONTROL_PANEL_MESSAGE_ID_FILE, 'r') as f:
             return int(f.read().strip())
     except (FileNotFoundError, ValueError, TypeError):
         return None
 
-def save_control_panel_message_id(message_id: int):
+async def save_control_panel_message_id(message_id: int):
     try:
+        if state_store:
+            await asyncio.to_thread(state_store.put, 'control_panel_message_id', message_id)
+            return
         with open(CONTROL_PANEL_MESSAGE_ID_FILE, 'w') as f:
             f.write(str(message_id))
     except Exception as e:
-        print(f"{log_ts()} Error saving Control Panel message ID: {e}")
+        panel_log.error("Error saving Control Panel message ID: %s", e)
+
+async def clear_control_panel_message_id():
+    if state_store:
+        try: await asyncio.to_thread(state_store.put, 'control_panel_message_id', 0)
+        except Exception as e: panel_log.error("Error clearing Control Panel message ID: %s", e)
+        return
+    if os.path.exists(CONTROL_PANEL_MESSAGE_ID_FILE):
+        try: os.remove(CONTROL_PANEL_MESSAGE_ID_FILE)
+        except OSError as e_rm: panel_log.error("Error removing %s: %s", CONTROL_PANEL_MESSAGE_ID_FILE, e_rm)
 
 async def delete_old_control_panel(channel: discord.TextChannel):
-    old_message_id = get_control_panel_message_id()
+    old_message_id = await get_control_panel_message_id()
     if old_message_id:
         try:
             message = await channel.fetch_message(old_message_id)
             await message.delete()
-            print(f"{log_ts()} Deleted old control panel (ID: {old_message_id})")
+            panel_log.info("Deleted old control panel (ID: %s)", old_message_id)
         except discord.NotFound:
-            print(f"{log_ts()} Old control panel (ID: {old_message_id}) not found. Already deleted?")
+            panel_log.warning("Old control panel (ID: %s) not found. Already deleted?", old_message_id)
         except discord.Forbidden:
-            print(f"{log_ts()} ERROR: No permission to delete old panel (ID: {old_message_id}) in {channel.name}")
+            panel_log.error("No permission to delete old panel (ID: %s) in %s", old_message_id, channel.name)
         except Exception as e:
-            print(f"{log_ts()} Error deleting old control panel (ID: {old_message_id}): {e}")
+            panel_log.error("Error deleting old control panel (ID: %s): %s", old_message_id, e)
         finally:
-            # Remove the ID file regardless of deletion success if it existed
-            if os.path.exists(CONTROL_PANEL_MESSAGE_ID_FILE):
-                try: os.remove(CONTROL_PANEL_MESSAGE_ID_FILE)
-                except OSError as e_rm: print(f"{log_ts()} Error removing {CONTROL_PANEL_MESSAGE_ID_FILE}: {e_rm}")
+            # Remove the stored ID regardless of deletion success
+            await clear_control_panel_message_id()
 
 
 async def setup_inventory_control_panel(force_new: bool = False):
-    print(f"{log_ts()} Attempting to setup/update inventory control panel (force_new={force_new})")
+    if not is_panel_leader:
+        # มีแค่ leader ที่แก้ไขพาเนลได้ การเปลี่ยนข้อมูลจะไปถึง leader ผ่าน state_changes อยู่แล้ว ส่วน force_new ต้องฝากคำขอไว้
+        if force_new:
+            await asyncio.to_thread(state_store.put, 'panel_refresh_request', {"requested_by": INSTANCE_ID, "requested_at": datetime.now(TZ_BANGKOK).isoformat()})
+        panel_log.debug("Not the panel leader; leaving panel update to the leader process (force_new=%s)", force_new)
+        return
+    panel_log.info("Attempting to setup/update inventory control panel (force_new=%s)", force_new)
     if not CONTROL_PANEL_CHANNEL_ID: # Check if ID is set
-        print(f"{log_ts()} !!! CRITICAL: CONTROL_PANEL_CHANNEL_ID is not set. Skipping panel setup.")
+        panel_log.critical("CONTROL_PANEL_CHANNEL_ID is not set. Skipping panel setup.")
         return
 
     channel = bot.get_channel(CONTROL_PANEL_CHANNEL_ID)
     if not channel:
-        print(f"{log_ts()} !!! CRITICAL: Control panel channel (ID: {CONTROL_PANEL_CHANNEL_ID}) not found. Bot may not have access or ID is incorrect.")
+        panel_log.critical("Control panel channel (ID: %s) not found. Bot may not have access or ID is incorrect.", CONTROL_PANEL_CHANNEL_ID)
         return
     if not isinstance(channel, discord.TextChannel):
-        print(f"{log_ts()} !!! CRITICAL: Control panel channel (ID: {CONTROL_PANEL_CHANNEL_ID}) is not a TextChannel.")
+        panel_log.critical("Control panel channel (ID: %s) is not a TextChannel.", CONTROL_PANEL_CHANNEL_ID)
         return
 
+    await load_data_async() # Load latest data before creating embed
     current_embed = create_control_panel_embed()
     persistent_view = PersistentInventoryView() # Always create a new view instance for sending/editing
 
-    message_id_to_edit = get_control_panel_message_id()
+    message_id_to_edit = await get_control_panel_message_id()
     message_object_to_edit = None
 
     if force_new:
-        print(f"{log_ts()} Force_new is True. Deleting old panel if exists.")
+        panel_log.info("Force_new is True. Deleting old panel if exists.")
         await delete_old_control_panel(channel)
         message_id_to_edit = None # Ensure we create a new one
 
     if not force_new and message_id_to_edit:
         try:
             message_object_to_edit = await channel.fetch_message(message_id_to_edit)
-            print(f"{log_ts()} Found existing panel (ID: {message_id_to_edit}) to edit.")
+            panel_log.info("Found existing panel (ID: %s) to edit.", message_id_to_edit)
         except discord.NotFound:
-            print(f"{log_ts()} Panel message (ID: {message_id_to_edit}) not found. Will create a new one.")
-            if os.path.exists(CONTROL_PANEL_MESSAGE_ID_FILE): os.remove(CONTROL_PANEL_MESSAGE_ID_FILE) # Clean up stale ID file
+            panel_log.warning("Panel message (ID: %s) not found. Will create a new one.", message_id_to_edit)
+            await clear_control_panel_message_id() # Clean up stale ID
             message_id_to_edit = None # Clear to ensure new message creation
         except discord.Forbidden:
-            print(f"{log_ts()} ERROR: No permission to fetch panel message (ID: {message_id_to_edit}). Will try to create new.")
+            panel_log.error("No permission to fetch panel message (ID: %s). Will try to create new.", message_id_to_edit)
             message_id_to_edit = None
         except Exception as e:
-            print(f"{log_ts()} Error fetching panel message (ID: {message_id_to_edit}): {e}. Will try to create new.")
+            panel_log.error("Error fetching panel message (ID: %s): %s. Will try to create new.", message_id_to_edit, e)
             message_id_to_edit = None
 
 
     try:
         if message_object_to_edit and not force_new : # Edit existing if found and not forced new
             await message_object_to_edit.edit(embed=current_embed, view=persistent_view)
-            print(f"{log_ts()} Successfully UPDATED control panel (ID: {message_object_to_edit.id}).")
+            panel_log.info("Successfully UPDATED control panel (ID: %s).", message_object_to_edit.id)
         else: # Create new panel
             new_message = await channel.send(embed=current_embed, view=persistent_view)
-            save_control_panel_message_id(new_message.id)
-            print(f"{log_ts()} Successfully CREATED NEW control panel (ID: {new_message.id}).")
+            await save_control_panel_message_id(new_message.id)
+            panel_log.info("Successfully CREATED NEW control panel (ID: %s).", new_message.id)
     except discord.Forbidden:
-        print(f"{log_ts()} !!! CRITICAL ERROR: Bot lacks permissions (Send Messages or Embed Links or Use External Emojis or Add Reactions) in channel ID {CONTROL_PANEL_CHANNEL_ID} to setup panel.")
+        panel_log.critical("Bot lacks permissions (Send Messages or Embed Links or Use External Emojis or Add Reactions) in channel ID %s to setup panel.", CONTROL_PANEL_CHANNEL_ID)
     except Exception as e:
-        print(f"{log_ts()} !!! CRITICAL ERROR during final panel setup (send/edit): {e}")
-        traceback.print_exc()
-
-
-# --- Scheduled Task ---
-# Correctly calculate next run time for tasks.loop
-def get_next_refresh_time_utc():
-    # Desired refresh time in Bangkok
-    target_hour_bkk_refresh = 8 # e.g., 8 AM Bangkok time
-    target_minute_bkk_refresh = 0
-
-    now_utc = datetime.now(pytz.utc)
-    now_bkk_for_calc = now_utc.astimezone(TZ_BANGKOK)
-
-    next_run_bkk = now_bkk_for_calc.replace(hour=target_hour_bkk_refresh, minute=target_minute_bkk_refresh, second=0, microsecond=0)
+        panel_log.critical("Error during final panel setup (send/edit): %s", e, exc_info=True)
+
+
+# --- Job Scheduler ---
+def parse_cron_field(field: str, low: int, high: int):
+    values = set()
+    for part in field.split(','):
+        span, _, step_text = part.partition('/')
+        step = int(step_text) if step_text else 1
+        if span == '*':
+            start, end = low, high
+        elif '-' in span:
+            start, end = (int(v) for v in span.split('-', 1))
+        else:
+            start = int(span)
+            end = high if step_text else start # "5/15" = ทุก 15 เริ่มที่ 5
+        if start < low or end > high or start > end or step < 1:
+            raise ValueError(f"Cron field '{field}' is outside {low}-{high}")
+        values.update(range(start, end + 1, step))
+    return values
+
+class CronSchedule:
+    # Five-field cron evaluated in Bangkok time. Day-of-month and day-of-week are OR'ed when both are set, as in cron.
+    def __init__(self, expression: str):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f"Cron expression '{expression}' must have 5 fields")
+        self.expression = expression
+        self.minutes = sorted(parse_cron_field(fields[0], 0, 59))
+        self.hours = sorted(parse_cron_field(fields[1], 0, 23))
+        self.days = parse_cron_field(fields[2], 1, 31)
+        self.months = parse_cron_field(fields[3], 1, 12)
+        self.weekdays = {d % 7 for d in parse_cron_field(fields[4], 0, 7)} # 0 และ 7 = วันอาทิตย์
+        self.days_restricted, self.weekdays_restricted = fields[2] != '*', fields[4] != '*'
+
+    def _day_matches(self, day: datetime) -> bool:
+        if day.month not in self.months:
+            return False
+        dom_ok, dow_ok = day.day in self.days, (day.weekday() + 1) % 7 in self.weekdays
+        if self.days_restricted and self.weekdays_restricted:
+            return dom_ok or dow_ok
+        return dom_ok and dow_ok
+
+    def next_after(self, after: datetime) -> datetime:
+        earliest = after.astimezone(TZ_BANGKOK).replace(tzinfo=None, second=0, microsecond=0) + timedelta(minutes=1)
+        day = earliest.replace(hour=0, minute=0)
+        for _ in range(366 * 5):
+            if self._day_matches(day):
+                for hour in self.hours:
+                    for minute in self.minutes:
+                        candidate = day.replace(hour=hour, minute=minute)
+                        if candidate >= earliest:
+                            return TZ_BANGKOK.localize(candidate)
+            day += timedelta(days=1)
+        raise ValueError(f"Cron expression '{self.expression}' never fires")
+
+class JobScheduler:
+    # One asyncio task sleeping on a heap of (fire_at, job name) instead of a tasks.loop per job.
+    MAX_SLEEP_SECONDS = 300 # ตื่นมาเช็คเป็นระยะ เผื่อนาฬิกาเครื่องถูกปรับ
+    RETRY_SCHEDULE_SECONDS = 60 # คำนวณรอบถัดไปไม่ได้ ลองใหม่หลังจากนี้ งานจะได้ไม่หายไปจาก heap
 
-    if next_run_bkk <= now_bkk_for_calc: # If target time for today has passed
-        next_run_bkk += timedelta(days=1)
+    def __init__(self):
+        self.jobs = {}
+        self.metrics = {}
+        self._heap = []
+        self._running = {}
+        self._task = None
+
+    def add_job(self, name: str, cron: str, handler, jitter_seconds: float = 0):
+        schedule = CronSchedule(cron)
+        schedule.next_after(datetime.now(TZ_BANGKOK)) # ให้ cron ที่ไม่มีวันตรง (เช่น 31 ก.พ.) ล้มตอนเริ่ม ไม่ใช่ retry ไปเรื่อย ๆ
+        self.jobs[name] = {"schedule": schedule, "handler": handler, "jitter_seconds": jitter_seconds}
+        self.metrics[name] = {"runs": 0, "failures": 0, "skipped_overlap": 0, "skipped_not_leader": 0, "last_started": None, "last_duration": None,
+                              "max_duration": 0.0, "total_duration": 0.0, "last_error": None, "next_run": None}
+
+    def _schedule(self, name: str, after: datetime):
+        job = self.jobs[name]
+        fire_at = job["schedule"].next_after(after).timestamp() + random.uniform(0, job["jitter_seconds"])
+        self.metrics[name]["next_run"] = datetime.fromtimestamp(fire_at, TZ_BANGKOK)
+        heapq.heappush(self._heap, (fire_at, name))
+
+    def is_running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        if self.is_running():
+            return
+        now = datetime.now(TZ_BANGKOK)
+        self._heap = []
+        for name in self.jobs:
+            self._reschedule(name, now)
+            task_log.info("Job %s (%s) next run: %s", name, self.jobs[name]["schedule"].expression, self.metrics[name]["next_run"].strftime('%Y-%m-%d %H:%M:%S %Z'))
+        self._task = asyncio.create_task(self._run_forever())
+        self._task.add_done_callback(self._on_task_done)
+
+    def _reschedule(self, name: str, after: datetime):
+        try:
+            self._schedule(name, after)
+        except Exception as e:
+            fire_at = after.timestamp() + self.RETRY_SCHEDULE_SECONDS
+            self.metrics[name]["next_run"] = datetime.fromtimestamp(fire_at, TZ_BANGKOK)
+            heapq.heappush(self._heap, (fire_at, name))
+            task_log.error("Could not compute next run for job %s, retrying in %ss: %s", name, self.RETRY_SCHEDULE_SECONDS, e, exc_info=True, extra={"job": name})
+
+    def _on_task_done(self, task: asyncio.Task):
+        if task.cancelled() or task.exception() is None:
+            return # ถูกหยุดเอง หรือไม่มีงานเหลือใน heap
+        error = task.exception()
+        task_log.error("Job scheduler stopped unexpectedly, restarting: %s", error, exc_info=error)
+        self.start()
+
+    async def _run_forever(self):
+        while self._heap:
+            fire_at, name = self._heap[0]
+            delay = fire_at - datetime.now(pytz.utc).timestamp()
+            if delay > 0:
+                await asyncio.sleep(min(delay, self.MAX_SLEEP_SECONDS))
+                continue
+            heapq.heappop(self._heap)
+            self._reschedule(name, datetime.now(TZ_BANGKOK)) # คิดจากเวลาปัจจุบัน ถ้าช้าไปหลายรอบจะไม่รันย้อนหลังรัว ๆ
+            try:
+                self._dispatch(name)
+            except Exception as e:
+                task_log.error("Error dispatching job %s: %s", name, e, exc_info=True, extra={"job": name})
 
-    next_run_utc = next_run_bkk.astimezone(pytz.utc)
-    print(f"{log_ts()} Next daily_panel_refresh scheduled for: {next_run_bkk.strftime('%Y-%m-%d %H:%M:%S %Z')} (BKK) / {next_run_utc.strftime('%Y-%m-%d %H:%M:%S %Z')} (UTC)")
-    return next_run_utc.timetz() # tasks.loop expects a datetime.time object in UTC
+    def _dispatch(self, name: str):
+        metrics = self.metrics[name]
+        if not is_panel_leader:
+            metrics["skipped_not_leader"] += 1
+            task_log.debug("Skipping job %s: not the panel leader.", name)
+            return
+        running = self._running.get(name)
+        if running and not running.done():
+            metrics["skipped_overlap"] += 1
+            task_log.warning("Skipping job %s: previous run is still in progress.", name, extra={"job": name})
+            return
+        self._running[name] = asyncio.create_task(self._run_job(name))
+
+    async def _run_job(self, name: str):
+        metrics = self.metrics[name]
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        metrics["last_started"] = datetime.now(TZ_BANGKOK)
+        ok = True
+        try:
+            await self.jobs[name]["handler"]()
+            metrics["last_error"] = None
+        except Exception as e:
+            ok = False
+            metrics["failures"] += 1
+            metrics["last_error"] = f"{e.__class__.__name__}: {e}"
+            task_log.error("Job %s failed: %s", name, e, exc_info=True, extra={"job": name})
+        finally:
+            duration = loop.time() - started
+            metrics["runs"] += 1
+            metrics["last_duration"] = duration
+            metrics["max_duration"] = max(metrics["max_duration"], duration)
+            metrics["total_duration"] += duration
+            task_log.info("Job %s finished in %.3fs", name, duration, extra={"job": name, "duration_ms": round(duration * 1000, 1), "ok": ok})
+
+job_scheduler = JobScheduler()
+
+# --- Background Panel Updates ---
+panel_update_pending = False
+panel_update_task = None
+
+def schedule_panel_update():
+    # Called from interaction handlers instead of awaiting the panel edit: bursts are coalesced into one edit
+    global panel_update_pending, panel_update_task
+    panel_update_pending = True
+    if panel_update_task is None or panel_update_task.done():
+        panel_update_task = asyncio.create_task(run_pending_panel_updates())
+
+async def run_pending_panel_updates():
+    global panel_update_pending
+    while panel_update_pending:
+        await asyncio.sleep(PANEL_UPDATE_DEBOUNCE_SECONDS)
+        panel_update_pending = False
+        try:
+            await setup_inventory_control_panel()
+        except Exception as e:
+            panel_log.error("Error in background panel update: %s", e, exc_info=True)
 
-# Initialize REFRESH_TIME_UTC for the first run.
-# tasks.loop will use this and then internally calculate the next run based on a 24-hour interval from this time.
-REFRESH_TIME_UTC = get_next_refresh_time_utc()
-print(f"{log_ts()} Initial REFRESH_TIME_UTC for tasks.loop: {REFRESH_TIME_UTC.strftime('%H:%M:%S %Z')}")
+# --- Scheduled Jobs ---
+async def panel_refresh_job():
+    # แก้ไขพาเนลเดิมถ้ายังเป็นข้อความล่าสุดในห้อง ลบแล้วส่งใหม่เฉพาะเมื่อมีข้อความอื่นดันพาเนลขึ้นไป
+    channel = bot.get_channel(CONTROL_PANEL_CHANNEL_ID)
+    panel_id = await get_control_panel_message_id()
+    still_latest = isinstance(channel, discord.TextChannel) and panel_id is not None and channel.last_message_id == panel_id
+    await setup_inventory_control_panel(force_new=not still_latest)
+
+def write_state_snapshot(inventory: dict, bank: dict):
+    taken_at = datetime.now(TZ_BANGKOK)
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    path = os.path.join(SNAPSHOT_DIR, f"state-{taken_at.strftime('%Y%m%d-%H%M%S')}.json")
+    write_json_atomic(path, {"taken_at": taken_at.isoformat(), "instance_id": INSTANCE_ID, "team_inventory": inventory, "team_bank": bank})
+    return path
+
+async def state_snapshot_job():
+    if state_store:
+        inventory, bank = await asyncio.to_thread(state_store.read_state)
+    else:
+        inventory, bank = team_inventory, team_bank # ถูกแทนที่ทั้งก้อนเมื่อมีธุรกรรม ไม่ถูกแก้ในที่ จึงส่งให้ thread อ่านได้
+    path = await asyncio.to_thread(write_state_snapshot, inventory, bank)
+    data_log.info("State snapshot written to %s", path)
+
+async def daily_digest_job():
+    now = datetime.now(TZ_BANGKOK)
+    entries = await asyncio.to_thread(read_ledger_entries_since, now - timedelta(days=1))
+    summary = {}
+    for entry in entries:
+        if entry["action"] not in ("deposit", "withdraw"):
+            continue
+        stats = summary.setdefault(entry["key"], {"deposit": 0, "withdraw": 0, "count": 0})
+        stats[entry["action"]] += abs(entry["delta"])
+        stats["count"] += 1
+
+    channel = bot.get_channel(DIGEST_CHANNEL_ID)
+    if not isinstance(channel, discord.TextChannel):
+        task_log.error("Digest channel (ID: %s) not found or not a TextChannel.", DIGEST_CHANNEL_ID)
+        return
+    embed = discord.Embed(title="📊 สรุปธุรกรรม 24 ชั่วโมงล่าสุด", color=discord.Color.purple())
+    if not summary:
+        embed.description = "ไม่มีธุรกรรมในช่วงนี้"
+    lines = []
+    for key in AVAILABLE_ITEMS:
+        if key in summary:
+            stats = summary[key]
+            lines.append(f"{ITEM_EMOJIS.get(key, '🔹')} {key}: ฝาก `{stats['deposit']}` / เบิก `{stats['withdraw']}` ({stats['count']} รายการ)")
+    if lines:
+        embed.add_field(name="ไอเทม", value="\n".join(lines), inline=False)
+    if BANK_LEDGER_KEY in summary:
+        stats = summary[BANK_LEDGER_KEY]
+        embed.add_field(name="💰 เงิน", value=f"ฝาก `{stats['deposit']:,}` / ถอน `{stats['withdraw']:,}` บาท ({stats['count']} รายการ)", inline=False)
+    embed.set_footer(text=f"ข้อมูล ณ {now.strftime('%d/%m/%Y %H:%M:%S')}")
+    await channel.send(embed=embed)
+
+async def ledger_compaction_job():
+    result = await verify_ledger_async()
+    if not result["ok"]:
+        ledger_log.error("Skipping ledger compaction: verification reported problems.")
+        return
+    cutoff = datetime.now(TZ_BANGKOK) - timedelta(hours=LEDGER_RETAIN_HOURS)
+    if state_store:
+        compacted = await asyncio.to_thread(state_store.compact_ledger, result["to_seq"], cutoff)
+    else:
+        base = load_ledger_base() or ledger_genesis()
+        new_base = await asyncio.to_thread(archive_ledger_file_prefix, base, load_ledger_checkpoint(), cutoff)
+        compacted = 0
+        if new_base:
+            async with ledger_file_lock: # ห้ามมี append แทรกระหว่างอ่านส่วนที่เหลือกับ replace ไฟล์
+                await asyncio.to_thread(swap_compacted_ledger_file, new_base)
+            compacted = new_base["seq"] - base["seq"]
+    ledger_log.info("Ledger compaction archived %s entries.", compacted)
+
+def remove_files_older_than(directory: str, cutoff: datetime):
+    removed = 0
+    if not os.path.isdir(directory):
+        return removed
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if os.path.isfile(path) and os.path.getmtime(path) < cutoff.timestamp():
+            os.remove(path)
+            removed += 1
+    return removed
+
+async def retention_cleanup_job():
+    now = datetime.now(TZ_BANGKOK)
+    snapshots = await asyncio.to_thread(remove_files_older_than, SNAPSHOT_DIR, now - timedelta(days=SNAPSHOT_RETENTION_DAYS))
+    if state_store:
+        changes, archived = await asyncio.to_thread(state_store.prune, now - timedelta(hours=STATE_CHANGES_RETENTION_HOURS), now - timedelta(days=LEDGER_ARCHIVE_RETENTION_DAYS))
+    else:
+        changes, archived = 0, await asyncio.to_thread(remove_files_older_than, LEDGER_ARCHIVE_DIR, now - timedelta(days=LEDGER_ARCHIVE_RETENTION_DAYS))
+    task_log.info("Retention cleanup removed %s snapshot(s), %s archived ledger item(s), %s state change row(s).", snapshots, archived, changes)
+
+JOB_HANDLERS = {
+    "panel_refresh": panel_refresh_job,
+    "state_snapshot": state_snapshot_job,
+    "daily_digest": daily_digest_job,
+    "ledger_compaction": ledger_compaction_job,
+    "retention_cleanup": retention_cleanup_job,
+}
+for job_name, job_config in SCHEDULED_JOBS.items():
+    if job_config.get("enabled", True):
+        job_scheduler.add_job(job_name, job_config["cron"], JOB_HANDLERS[job_name], job_config.get("jitter_seconds", 0))
 
 
-@tasks.loop(time=REFRESH_TIME_UTC) # This time is UTC
-async def daily_panel_refresh():
-    print(f"{log_ts()} === Daily Panel Refresh Task Triggered ===")
-    print(f"{log_ts()} Expected UTC for this run: {REFRESH_TIME_UTC.strftime('%H:%M:%S %Z')}")
-    print(f"{log_ts()} Actual current UTC: {datetime.now(pytz.utc).strftime('%H:%M:%S %Z')}")
+# --- Shared State Sync (STATE_STORE=sqlite only) ---
+@tasks.loop(seconds=STATE_POLL_SECONDS)
+async def shared_state_watch():
+    global state_cache_valid
     try:
-        await setup_inventory_control_panel(force_new=True)
-        print(f"{log_ts()} Daily panel refresh task execution completed successfully.")
-    except Exception as e_task:
-        print(f"{log_ts()} !!! ERROR during daily_panel_refresh execution: {e_task}")
-        traceback.print_exc()
-    print(f"{log_ts()} === Daily Panel Refresh Task Finished ===")
-    # The loop will automatically schedule for the same UTC time next day.
+        changes = await asyncio.to_thread(state_store.poll_changes)
+    except Exception as e:
+        state_cache_valid = False # ไม่รู้ว่าพลาดการเปลี่ยนแปลงอะไรไปบ้าง ให้โหลดจาก store ใหม่ครั้งถัดไป
+        data_log.error("Error polling shared state changes: %s", e, exc_info=True)
+        return
+    foreign_keys = {key for _seq, key, origin in changes if origin != INSTANCE_ID}
+    if not foreign_keys:
+        return # การเขียนของเราเองอัปเดตตัวแปรในหน่วยความจำไปแล้ว
+    state_cache_valid = False
+    data_log.debug("State cache invalidated by other processes: %s", sorted(foreign_keys))
+    try:
+        if is_panel_leader and 'panel_refresh_request' in foreign_keys:
+            await setup_inventory_control_panel(force_new=True)
+        elif is_panel_leader and foreign_keys & {'team_inventory', 'team_bank'}:
+            schedule_panel_update()
+    except Exception as e:
+        panel_log.error("Error refreshing panel after shared state change: %s", e, exc_info=True)
+
+@shared_state_watch.error
+async def shared_state_watch_error(error):
+    global state_cache_valid
+    state_cache_valid = False
+    data_log.error("shared_state_watch stopped unexpectedly, restarting: %s", error, exc_info=error)
+    shared_state_watch.restart()
+
+@tasks.loop(seconds=LEADER_LEASE_SECONDS / 3)
+async def leader_lease_keeper():
+    global is_panel_leader
+    try:
+        acquired = await asyncio.to_thread(state_store.try_acquire_lease, PANEL_LEASE_NAME, LEADER_LEASE_SECONDS)
+    except Exception as e:
+        log.error("Error renewing panel leader lease: %s", e, exc_info=True)
+        acquired = False # ยืนยัน lease ไม่ได้ ถือว่าไม่ใช่ leader เพื่อไม่ให้มีสองโปรเซสแก้พาเนลพร้อมกัน
+    if acquired and not is_panel_leader:
+        is_panel_leader = True
+        log.info("Instance %s is now the panel leader.", INSTANCE_ID)
+        schedule_panel_update() # ตั้งพาเนลเบื้องหลัง ลูปนี้ต้องต่อ lease ให้ทันก่อนหมดอายุ แม้ Discord จะช้าหรือโดน rate limit
+    elif not acquired and is_panel_leader:
+        is_panel_leader = False
+        log.warning("Instance %s lost panel leadership.", INSTANCE_ID) # job_scheduler เช็ค leadership ตอนจะรันแต่ละงานเอง
+
+@leader_lease_keeper.error
+async def leader_lease_keeper_error(error):
+    global is_panel_leader
+    # ระหว่างที่ลูปไม่ทำงาน lease จะหมดอายุและโปรเซสอื่นรับต่อได้ จึงต้องลงจาก leader ทันที
+    is_panel_leader = False
+    log.error("leader_lease_keeper stopped unexpectedly, restarting: %s", error, exc_info=error)
+    leader_lease_keeper.restart()
+
+def start_shared_state_tasks():
+    for task in (shared_state_watch, leader_lease_keeper):
+        if not task.is_running():
+            task.start()
+    log.info("Shared state tasks running (instance: %s, db: %s).", INSTANCE_ID, STATE_DB_FILE)
 
 
 # --- Bot Commands ---
 @bot.command(name="ดูของ", aliases=["คลัง", "inventory"])
 async def show_inventory_command(ctx):
-    load_data() # Ensure latest data
+    await load_data_async() # Ensure latest data
     embed = discord.Embed(title="📦 สรุปยอดคลังกลางทั้งหมด 📦", color=discord.Color.gold())
 
     item_list_lines = []
@@ -603,8 +1714,7 @@ async def force_refresh_panel_command(ctx):
         await msg_feedback.edit(content="✅ Control Panel ถูกรีเฟรชเรียบร้อยแล้ว!", delete_after=10)
     except Exception as e:
         await msg_feedback.edit(content=f"❌ เกิดข้อผิดพลาดในการรีเฟรช: {e}", delete_after=15)
-        print(f"{log_ts()} Error in force_refresh_panel_command: {e}")
-        traceback.print_exc()
+        panel_log.error("Error in force_refresh_panel_command: %s", e, exc_info=True)
 
 @force_refresh_panel_command.error
 async def force_refresh_panel_error(ctx, error):
@@ -612,14 +1722,69 @@ async def force_refresh_panel_error(ctx, error):
         await ctx.send("🚫 คุณไม่มีสิทธิ์ใช้คำสั่งนี้", ephemeral=True, delete_after=10)
     else:
         await ctx.send(f"เกิดข้อผิดพลาด: {error}", ephemeral=True, delete_after=10)
-        print(f"{log_ts()} Error in force_refresh_panel_command (handler): {error}")
+        panel_log.error("Error in force_refresh_panel_command (handler): %s", error)
+
+@bot.command(name="ตรวจสอบบัญชี", aliases=["verifyledger", "ledgercheck"])
+@commands.has_permissions(administrator=True)
+async def verify_ledger_command(ctx, mode: str = ""):
+    full = mode.lower() == "full" # $$verifyledger full = ตรวจใหม่ตั้งแต่ entry แรก ไม่ใช้ checkpoint
+    result = await verify_ledger_async(full)
+
+    embed = discord.Embed(title="🧾 ตรวจสอบความถูกต้องของคลัง", color=discord.Color.green() if result["ok"] else discord.Color.red())
+    if result["entries_checked"]:
+        embed.description = f"ตรวจธุรกรรม #{result['from_seq'] + 1} ถึง #{result['to_seq']} ({result['entries_checked']} รายการใหม่)"
+    else:
+        embed.description = f"ไม่มีธุรกรรมใหม่หลัง #{result['from_seq']} ตรวจเฉพาะยอดคงเหลือ"
+    if result["chain_break"]:
+        embed.add_field(name="⛓️ Hash chain ขาด", value=f"ที่ธุรกรรม #{result['chain_break']['seq']} (รายการ: {result['chain_break']['key'] or 'อ่านไม่ได้'})", inline=False)
+    for d in result["divergences"][:20]: # Embed มีได้สูงสุด 25 fields
+        name = "ยอดเงิน" if d["key"] == BANK_LEDGER_KEY else d["key"]
+        embed.add_field(name=f"⚠️ {ITEM_EMOJIS.get(d['key'], '💰' if d['key'] == BANK_LEDGER_KEY else '🔹')} {name}",
+                        value=f"ledger: `{d['expected']:,}` / คลัง: `{d['actual']:,}`" + (f" / checkpoint: `{d['checkpoint_total']:,}`" if "checkpoint_total" in d else "")
+                              + f"\nธุรกรรม #{d['from_seq']} – #{d['to_seq']}\n{d['reason']}", inline=False)
+    if result["ok"]:
+        embed.add_field(name="✅ ยอดตรงกับ ledger", value=f"checkpoint เลื่อนไปที่ #{result['to_seq']}", inline=False)
+    embed.timestamp = datetime.now(TZ_BANGKOK)
+    await ctx.send(embed=embed)
+
+@bot.command(name="สถานะงาน", aliases=["jobs", "schedule"])
+@commands.has_permissions(administrator=True)
+async def job_status_command(ctx):
+    embed = discord.Embed(title="⏱️ สถานะงานตามเวลา", color=discord.Color.blurple())
+    embed.description = "Scheduler กำลังทำงาน" if job_scheduler.is_running() else "⚠️ Scheduler ยังไม่ได้เริ่ม"
+    if state_store and not is_panel_leader:
+        embed.description += " (โปรเซสนี้ไม่ใช่ leader งานจะไปรันที่ leader)"
+    for name, job in job_scheduler.jobs.items():
+        m = job_scheduler.metrics[name]
+        next_run = m["next_run"].strftime('%d/%m %H:%M:%S') if m["next_run"] else "-"
+        last_duration = f"{m['last_duration']:.2f}s" if m["last_duration"] is not None else "-"
+        average = f"{m['total_duration'] / m['runs']:.2f}s" if m["runs"] else "-"
+        value = (f"`{job['schedule'].expression}` รอบถัดไป: {next_run}\n"
+                 f"รัน {m['runs']} | ล้มเหลว {m['failures']} | ข้ามเพราะรอบก่อนยังไม่จบ {m['skipped_overlap']}\n"
+                 f"ใช้เวลา ล่าสุด {last_duration} / เฉลี่ย {average} / สูงสุด {m['max_duration']:.2f}s")
+        if m["last_error"]:
+            value += f"\n❌ {m['last_error'][:200]}"
+        embed.add_field(name=name, value=value, inline=False)
+    embed.timestamp = datetime.now(TZ_BANGKOK)
+    await ctx.send(embed=embed)
 
 # --- Bot Events ---
 @bot.event
 async def on_ready():
-    print(f"{log_ts()} Bot {bot.user.name} ({bot.user.id}) is attempting to connect and initialize...")
-    load_data()
-    print(f"{log_ts()} Initial data loaded.")
+    log.info("Bot %s (%s) is attempting to connect and initialize...", bot.user.name, bot.user.id)
+    try:
+        if state_store:
+            await asyncio.to_thread(seed_state_store_from_files)
+        await load_data_async()
+    except Exception as e:
+        # ไม่หยุด on_ready ตรงนี้ ไม่งั้น shared-state tasks กับ scheduler จะไม่เริ่ม (cache ยังไม่ valid จะโหลดใหม่ครั้งถัดไปที่ใช้)
+        data_log.error("Error loading initial state: %s", e, exc_info=True)
+    if state_store:
+        await asyncio.to_thread(ensure_ledger_opened)
+    else:
+        async with ledger_file_lock:
+            ensure_ledger_opened()
+    log.info("Initial data loaded.")
 
     # Register persistent view if not already done (important for restarts)
     # Check if a view with the same custom_ids is already registered; discord.py handles this better in recent versions.
@@ -627,43 +1792,38 @@ async def on_ready():
     # For robustness, you might want to track if you've added it in this session.
     if not bot.persistent_views: # Or a more specific check if you have multiple persistent views
         bot.add_view(PersistentInventoryView())
-        print(f"{log_ts()} PersistentInventoryView registered with the bot.")
+        log.info("PersistentInventoryView registered with the bot.")
     else:
         # Check if our specific view is among them
         # This check is a bit tricky as you'd need to compare types or custom_ids.
         # For simplicity, if any persistent view exists, we assume ours might be among them from a previous (failed) on_ready.
         # Re-adding is generally safe.
-        print(f"{log_ts()} Bot already has persistent views. Attempting to add/re-add ours.")
+        log.info("Bot already has persistent views. Attempting to add/re-add ours.")
         bot.add_view(PersistentInventoryView()) # Re-adding is generally okay.
 
-    await setup_inventory_control_panel(force_new=False) # Attempt to update or create panel
-    print(f"{log_ts()} Initial Control Panel setup/update completed.")
+    if state_store:
+        # โหมด sqlite: leader_lease_keeper จะตั้งพาเนลเองเมื่อโปรเซสนี้ได้เป็น leader
+        start_shared_state_tasks()
+    else:
+        try:
+            await setup_inventory_control_panel(force_new=False) # Attempt to update or create panel
+            log.info("Initial Control Panel setup/update completed.")
+        except Exception as e_panel:
+            panel_log.error("Error during initial Control Panel setup: %s", e_panel, exc_info=True)
 
     try:
         await bot.change_presence(activity=discord.Game(name=f"ดูแลคลัง | {bot.command_prefix}คลัง"))
-        print(f"{log_ts()} Bot presence set.")
+        log.info("Bot presence set.")
     except Exception as e_presence:
-        print(f"{log_ts()} Error setting bot presence: {e_presence}")
+        log.error("Error setting bot presence: %s", e_presence)
 
-
-    print(f"{log_ts()} Attempting to start daily_panel_refresh task loop...")
-    if not daily_panel_refresh.is_running():
-        try:
-            daily_panel_refresh.start()
-            if daily_panel_refresh.is_running():
-                print(f"{log_ts()} Daily panel refresh task STARTED. Next run based on calculated UTC time.")
-            else:
-                print(f"!!! {log_ts()} CRITICAL WARNING: daily_panel_refresh.start() was called, but task IS NOT RUNNING. Check task logic and conditions.")
-        except RuntimeError as e_runtime: # e.g. "Event loop is closed"
-             print(f"!!! {log_ts()} CRITICAL RuntimeError starting daily_panel_refresh task (event loop issue?): {e_runtime}")
-             traceback.print_exc()
-        except Exception as e_task_start:
-            print(f"!!! {log_ts()} CRITICAL EXCEPTION starting daily_panel_refresh task: {e_task_start}")
-            traceback.print_exc()
+    if not job_scheduler.is_running():
+        job_scheduler.start()
+        task_log.info("Job scheduler started with %s job(s).", len(job_scheduler.jobs))
     else:
-        print(f"{log_ts()} Daily panel refresh task is ALREADY running.")
+        task_log.info("Job scheduler is ALREADY running.")
 
-    print(f"{log_ts()} ------ Bot {bot.user.name} is fully ready and online! ------")
+    log.info("------ Bot %s is fully ready and online! ------", bot.user.name)
 
 
 @bot.event
@@ -677,15 +1837,13 @@ async def on_command_error(ctx, error):
             pass # Ignore if cannot send response (e.g., channel deleted)
     elif isinstance(error, commands.CommandInvokeError):
         original = error.original
-        print(f'{log_ts()} Error in command {ctx.command}: {original}')
-        traceback.print_tb(original.__traceback__)
+        log.error("Error in command %s: %s", ctx.command, original, exc_info=original)
         try:
             await ctx.send(f"เกิดข้อผิดพลาดขณะรันคำสั่ง: `{original.__class__.__name__}`. แจ้งผู้ดูแล.", ephemeral=True, delete_after=15)
         except discord.HTTPException:
             pass
     else:
-        print(f'{log_ts()} Unhandled command error for command "{ctx.command}" by "{ctx.author}": {error}')
-        traceback.print_exc()
+        log.error('Unhandled command error for command "%s" by "%s": %s', ctx.command, ctx.author, error, exc_info=error)
 
 # --- START: Keep Alive Web Server ---
 flask_app = Flask('')
@@ -697,13 +1855,12 @@ def flask_home():
 def run_flask():
   # Get port from environment variable or default to 8080 for local
   port = int(os.environ.get('PORT', 8080))
-  print(f"{log_ts()} Flask server attempting to run on host 0.0.0.0, port {port}")
+  web_log.info("Flask server attempting to run on host 0.0.0.0, port %s", port)
   try:
     flask_app.run(host='0.0.0.0', port=port)
-    print(f"{log_ts()} Flask server started successfully on port {port}.") # This line might not be reached if run blocks
+    web_log.info("Flask server started successfully on port %s.", port) # This line might not be reached if run blocks
   except Exception as e_flask_run:
-    print(f"{log_ts()} !!! ERROR starting Flask server: {e_flask_run}")
-    traceback.print_exc()
+    web_log.error("Error starting Flask server: %s", e_flask_run, exc_info=True)
 
 
 def start_flask_server_if_needed():
@@ -711,31 +1868,37 @@ def start_flask_server_if_needed():
     # On Render, we need this to be a web service.
     # You could add another env var to explicitly disable Flask if needed for other environments.
     # For Render deployment, we WANT this to run.
-    print(f"{log_ts()} Starting Flask server for web service...")
+    web_log.info("Starting Flask server for web service...")
     t = Thread(target=run_flask)
     t.daemon = True # Ensures thread exits when main program exits
     t.start()
-    print(f"{log_ts()} Flask server thread initiated.")
+    web_log.info("Flask server thread initiated.")
 
 # --- END: Keep Alive Web Server ---
 
 
 # --- Run Bot ---
 if __name__ == '__main__':
+    if RUNNING_LEDGER_CLI:
+        # Offline: python main.py verify-ledger [--full]  ไม่ต้องใช้ token และไม่เชื่อมต่อ Discord
+        # โหมดไฟล์ควรรันตอนบอทหยุดอยู่ เพราะอ่านไฟล์ชุดเดียวกับที่บอทเขียน
+        ledger_result = verify_ledger(full='--full' in sys.argv[2:])
+        print("\n".join(format_ledger_report(ledger_result)))
+        sys.exit(0 if ledger_result["ok"] else 1)
+
     BOT_TOKEN = os.environ.get('INVENTORY_BOT_TOKEN') # ใช้ชื่อนี้บน Render Env Vars
 
     if BOT_TOKEN:
         try:
             start_flask_server_if_needed() # Start Flask server in a thread
-            print(f"{log_ts()} Attempting to run Discord bot with token: ...{BOT_TOKEN[-6:]}")
-            bot.run(BOT_TOKEN)
+            log.info("Attempting to run Discord bot with token: ...%s", BOT_TOKEN[-6:])
+            bot.run(BOT_TOKEN, log_handler=None) # discord.py ใช้ root logger ของเรา (คิว + JSON) แทน handler ของตัวเอง
         except discord.errors.LoginFailure:
-            print(f"{log_ts()} !!! CRITICAL LOGIN FAILURE: Improper token. Check your INVENTORY_BOT_TOKEN environment variable. !!!")
+            log.critical("LOGIN FAILURE: Improper token. Check your INVENTORY_BOT_TOKEN environment variable.")
         except discord.errors.PrivilegedIntentsRequired:
-            print(f"{log_ts()} !!! CRITICAL INTENTS ERROR: Privileged server members and/or message content intent not enabled on Discord Developer Portal. !!!")
+            log.critical("INTENTS ERROR: Privileged server members and/or message content intent not enabled on Discord Developer Portal.")
         except Exception as e_main_run:
-            print(f"{log_ts()} !!! AN UNEXPECTED CRITICAL ERROR occurred during bot.run(): {e_main_run} !!!")
-            traceback.print_exc()
+            log.critical("AN UNEXPECTED CRITICAL ERROR occurred during bot.run(): %s", e_main_run, exc_info=True)
     else:
-        print(f"{log_ts()} !!! BOT TOKEN NOT FOUND: 'INVENTORY_BOT_TOKEN' environment variable is missing. Bot cannot start. !!!")
-        print(f"{log_ts()} Please set the INVENTORY_BOT_TOKEN environment variable (e.g., in a .env file for local, or in Render's settings).")
\ No newline at end of file
+        log.critical("BOT TOKEN NOT FOUND: 'INVENTORY_BOT_TOKEN' environment variable is missing. Bot cannot start.")
+        log.critical("Please set the INVENTORY_BOT_TOKEN environment variable (e.g., in a .env file for local, or in Render's settings).")
\ No newline at end of file
@@ -0,0 +1,233 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+os.environ.setdefault("LOG_LEVEL", "CRITICAL")
+
+import main
+
+ITEM = main.AVAILABLE_ITEMS[0]
+
+
+class FakeUser:
+    id = 1
+    name = "tester"
+
+
+def rewrite_ledger_file(entries, rehash: bool):
+    # เขียน ledger ใหม่ทั้งไฟล์ ถ้า rehash จะต่อ chain ใหม่ให้สอดคล้องกัน (เหมือนคนแก้ประวัติอย่างตั้งใจ)
+    prev_hash = main.LEDGER_GENESIS_HASH
+    with open(main.LEDGER_FILE, 'w', encoding='utf-8') as f:
+        for entry in entries:
+            if rehash:
+                entry = {k: v for k, v in entry.items() if k != "hash"}
+                entry["prev_hash"] = prev_hash
+                entry["hash"] = main.compute_ledger_hash(entry)
+                prev_hash = entry["hash"]
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+
+class LedgerTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmpdir = tempfile.mkdtemp()
+        os.chdir(self.tmpdir) # ไฟล์ของโหมดไฟล์เป็น path สัมพัทธ์
+        self.patches = [
+            mock.patch.object(main, 'ledger_file_head', None),
+            mock.patch.object(main, 'team_inventory', {item: 0 for item in main.AVAILABLE_ITEMS}),
+            mock.patch.object(main, 'team_bank', {"balance": 0, "log": []}),
+            mock.patch.object(main, 'state_store', self.make_store()),
+            mock.patch.object(main, 'state_cache_valid', False),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in reversed(self.patches):
+            patch.stop()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def make_store(self):
+        return None
+
+    async def deposit_bank(self, amount):
+        self.assertTrue(await main.update_bank_action(amount, "deposit", FakeUser, "test"))
+
+    async def deposit_item(self, quantity):
+        self.assertTrue(await main.update_inventory_action(ITEM, quantity, "deposit", FakeUser))
+
+    async def make_history(self):
+        await self.deposit_item(5)
+        for _ in range(3):
+            await self.deposit_bank(100)
+        await self.deposit_item(5)
+
+
+class FileLedgerTest(LedgerTestCase):
+    def read_entries(self):
+        with open(main.LEDGER_FILE, encoding='utf-8') as f:
+            return [json.loads(line) for line in f]
+
+    async def test_entries_form_a_hash_chain(self):
+        await self.make_history()
+        entries = self.read_entries()
+        self.assertEqual([e["seq"] for e in entries], [1, 2, 3, 4, 5])
+        self.assertEqual(entries[0]["prev_hash"], main.LEDGER_GENESIS_HASH)
+        for prev, entry in zip(entries, entries[1:]):
+            self.assertEqual(entry["prev_hash"], prev["hash"])
+            self.assertEqual(entry["hash"], main.compute_ledger_hash(entry))
+
+    async def test_incremental_verify_starts_at_checkpoint(self):
+        await self.make_history()
+        first = main.verify_ledger()
+        self.assertTrue(first["ok"])
+        self.assertEqual((first["from_seq"], first["to_seq"]), (0, 5))
+        self.assertEqual(main.load_ledger_checkpoint()["seq"], 5)
+        await self.deposit_bank(1)
+        await self.deposit_bank(2)
+        second = main.verify_ledger()
+        self.assertTrue(second["ok"])
+        self.assertEqual((second["from_seq"], second["to_seq"], second["entries_checked"]), (5, 7, 2))
+
+    async def test_tampering_without_rehash_breaks_chain(self):
+        await self.make_history()
+        entries = self.read_entries()
+        entries[2]["delta"] = 150
+        rewrite_ledger_file(entries, rehash=False)
+        result = main.verify_ledger(full=True)
+        self.assertFalse(result["ok"])
+        self.assertEqual(result["chain_break"], {"seq": 3, "key": main.BANK_LEDGER_KEY})
+
+    async def test_rehashed_rewrite_is_caught_by_checkpoint_checksum(self):
+        await self.make_history()
+        self.assertTrue(main.verify_ledger()["ok"])
+        entries = self.read_entries()
+        entries[2]["delta"] += 50 # ธุรกรรม #3 ฝาก 150 แทน 100 แล้วแก้ after และ state ให้ตรง
+        for entry in entries[2:]:
+            if entry["key"] == main.BANK_LEDGER_KEY:
+                entry["after"] += 50
+        rewrite_ledger_file(entries, rehash=True)
+        main.save_bank_data({"balance": 350, "log": []})
+
+        result = main.verify_ledger(full=True)
+        self.assertFalse(result["ok"])
+        self.assertIsNone(result["chain_break"])
+        self.assertEqual(len(result["divergences"]), 1) # ไอเทมที่ไม่ถูกแตะต้องไม่ถูกรายงาน
+        divergence = result["divergences"][0]
+        self.assertEqual(divergence["key"], main.BANK_LEDGER_KEY)
+        self.assertEqual((divergence["expected"], divergence["actual"], divergence["checkpoint_total"]), (350, 350, 300))
+        self.assertEqual((divergence["from_seq"], divergence["to_seq"]), (2, 4))
+        self.assertEqual(main.load_ledger_checkpoint()["seq"], 5) # ไม่เลื่อน checkpoint เมื่อไม่ผ่าน
+
+    async def test_truncated_ledger_is_reported(self):
+        await self.make_history()
+        self.assertTrue(main.verify_ledger()["ok"])
+        rewrite_ledger_file(self.read_entries()[:-1], rehash=False)
+        result = main.verify_ledger(full=True)
+        self.assertFalse(result["ok"])
+        removed = [d for d in result["divergences"] if "checkpoint_total" in d]
+        self.assertEqual([(d["key"], d["checkpoint_total"], d["to_seq"]) for d in removed], [(ITEM, 10, 5)])
+
+    async def test_state_drift_is_reported(self):
+        await self.make_history()
+        main.save_bank_data({"balance": 999, "log": []})
+        result = main.verify_ledger()
+        self.assertFalse(result["ok"])
+        self.assertEqual([(d["key"], d["expected"], d["actual"]) for d in result["divergences"]], [(main.BANK_LEDGER_KEY, 300, 999)])
+
+    async def test_stale_checkpoint_offset_mid_line(self):
+        await self.make_history()
+        self.assertTrue(main.verify_ledger()["ok"])
+        checkpoint = main.load_ledger_checkpoint()
+        main.save_ledger_checkpoint({**checkpoint, "offset": checkpoint["offset"] - 7})
+        await self.deposit_bank(1)
+        result = main.verify_ledger()
+        self.assertTrue(result["ok"], result)
+        self.assertEqual(result["to_seq"], 6)
+
+    async def test_failed_append_does_not_save_state(self):
+        await self.deposit_bank(100)
+        with mock.patch.object(main, 'LEDGER_FILE', os.path.join("missing", main.LEDGER_FILE)), \
+             mock.patch.object(main, 'save_bank_data') as save_bank:
+            with self.assertRaises(OSError):
+                await main.update_bank_action(50, "deposit", FakeUser, "test")
+            save_bank.assert_not_called()
+        self.assertEqual(main.team_bank["balance"], 100)
+        await self.deposit_bank(1)
+        self.assertTrue(main.verify_ledger(full=True)["ok"])
+
+    async def test_compaction_then_verify(self):
+        await self.make_history()
+        with mock.patch.object(main, 'LEDGER_RETAIN_HOURS', -1):
+            await main.ledger_compaction_job()
+        base = main.load_ledger_base()
+        self.assertEqual((base["seq"], base["offset"]), (5, 0))
+        self.assertEqual(len(os.listdir(main.LEDGER_ARCHIVE_DIR)), 1)
+        self.assertEqual(os.path.getsize(main.LEDGER_FILE), 0)
+        await self.deposit_bank(1)
+        self.assertEqual(self.read_entries()[0]["prev_hash"], base["hash"])
+        self.assertTrue(main.verify_ledger()["ok"])
+        full = main.verify_ledger(full=True)
+        self.assertTrue(full["ok"])
+        self.assertEqual((full["from_seq"], full["to_seq"]), (5, 6))
+
+
+class SqliteLedgerTest(LedgerTestCase):
+    def make_store(self):
+        return main.SharedStateStore(os.path.join(self.tmpdir, "state.db"), "test-instance")
+
+    def rewrite_rows(self, mutate):
+        # แก้ entry ใน ledger_entries แล้วต่อ chain ใหม่ทั้งหมด
+        conn = main.state_store._conn
+        entries = [json.loads(row[0]) for row in conn.execute("SELECT entry FROM ledger_entries ORDER BY seq")]
+        mutate(entries)
+        prev_hash = main.LEDGER_GENESIS_HASH
+        for entry in entries:
+            entry.pop("hash")
+            entry["prev_hash"] = prev_hash
+            entry["hash"] = prev_hash = main.compute_ledger_hash(entry)
+            conn.execute("UPDATE ledger_entries SET entry = ? WHERE seq = ?", (json.dumps(entry, ensure_ascii=False), entry["seq"]))
+
+    async def test_verify_and_rehashed_rewrite(self):
+        await self.make_history()
+        self.assertTrue(main.verify_ledger()["ok"])
+        await self.deposit_bank(1)
+        incremental = main.verify_ledger()
+        self.assertEqual((incremental["from_seq"], incremental["entries_checked"]), (5, 1))
+
+        def bump_first_item_deposit(entries):
+            entries[0]["delta"] += 1
+            for entry in entries:
+                if entry["key"] == ITEM:
+                    entry["after"] += 1
+        self.rewrite_rows(bump_first_item_deposit)
+        main.state_store.put('team_inventory', {**main.team_inventory, ITEM: 11})
+        result = main.verify_ledger(full=True)
+        self.assertFalse(result["ok"])
+        self.assertEqual([(d["key"], d["checkpoint_total"], d["actual"]) for d in result["divergences"]], [(ITEM, 10, 11)])
+
+    async def test_checkpoint_never_moves_backwards(self):
+        await self.make_history()
+        self.assertTrue(main.verify_ledger()["ok"])
+        stale = {**main.load_ledger_checkpoint(), "seq": 2}
+        self.assertFalse(main.state_store.save_ledger_checkpoint(stale))
+        self.assertEqual(main.load_ledger_checkpoint()["seq"], 5)
+
+    async def test_compaction_then_verify(self):
+        await self.make_history()
+        with mock.patch.object(main, 'LEDGER_RETAIN_HOURS', -1):
+            await main.ledger_compaction_job()
+        self.assertEqual(main.load_ledger_base()["seq"], 5)
+        self.assertEqual(main.state_store.ledger_entries(), [])
+        await self.deposit_item(1)
+        full = main.verify_ledger(full=True)
+        self.assertTrue(full["ok"], full)
+        self.assertEqual((full["from_seq"], full["to_seq"]), (5, 6))
+
+
+if __name__ == '__main__':
+    unittest.main()
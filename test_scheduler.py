@@ -0,0 +1,127 @@
+import asyncio
+import os
+import unittest
+from datetime import datetime
+from unittest import mock
+
+os.environ.setdefault("LOG_LEVEL", "CRITICAL")
+
+import main
+
+
+def bangkok(*args):
+    return main.TZ_BANGKOK.localize(datetime(*args))
+
+
+class CronTest(unittest.TestCase):
+    def test_parse_field(self):
+        self.assertEqual(main.parse_cron_field("*/15", 0, 59), {0, 15, 30, 45})
+        self.assertEqual(main.parse_cron_field("5/15", 0, 59), {5, 20, 35, 50}) # a/n = ทุก n เริ่มที่ a
+        self.assertEqual(main.parse_cron_field("1-5/2", 0, 6), {1, 3, 5})
+        self.assertEqual(main.parse_cron_field("1,3,10-12", 1, 31), {1, 3, 10, 11, 12})
+        for bad in ("60", "5-1", "*/0", "0-24"):
+            with self.assertRaises(ValueError):
+                main.parse_cron_field(bad, 0, 23 if bad == "0-24" else 59)
+
+    def test_expression_needs_five_fields(self):
+        with self.assertRaises(ValueError):
+            main.CronSchedule("0 8 * *")
+
+    def test_next_after(self):
+        weekdays = main.CronSchedule("30 9 * * 1-5")
+        self.assertEqual(weekdays.next_after(bangkok(2026, 10, 16, 10, 0)), bangkok(2026, 10, 19, 9, 30)) # ศุกร์ -> จันทร์
+        self.assertEqual(weekdays.next_after(bangkok(2026, 10, 19, 9, 29, 59)), bangkok(2026, 10, 19, 9, 30))
+        self.assertEqual(weekdays.next_after(bangkok(2026, 10, 19, 9, 30)), bangkok(2026, 10, 20, 9, 30)) # ไม่คืนเวลาเดิมซ้ำ
+        self.assertEqual(main.CronSchedule("0 8 * * 7").next_after(bangkok(2026, 10, 19, 0, 0)), bangkok(2026, 10, 25, 8, 0)) # 7 = อาทิตย์
+
+    def test_next_after_converts_to_bangkok(self):
+        utc = main.pytz.utc.localize(datetime(2026, 10, 19, 1, 0)) # 08:00 ที่กรุงเทพ
+        self.assertEqual(main.CronSchedule("0 9 * * *").next_after(utc), bangkok(2026, 10, 19, 9, 0))
+
+    def test_day_of_month_or_day_of_week(self):
+        schedule = main.CronSchedule("0 8 1 * 1") # วันที่ 1 หรือวันจันทร์
+        self.assertEqual(schedule.next_after(bangkok(2026, 10, 19, 9, 0)), bangkok(2026, 10, 26, 8, 0))
+        self.assertEqual(schedule.next_after(bangkok(2026, 10, 27, 9, 0)), bangkok(2026, 11, 1, 8, 0)) # อาทิตย์ที่ 1 ก่อนจันทร์ที่ 2
+
+    def test_impossible_schedule_fails_at_add_job(self):
+        with self.assertRaises(ValueError):
+            main.CronSchedule("0 0 31 2 *").next_after(bangkok(2026, 10, 19, 0, 0))
+        scheduler = main.JobScheduler()
+        with self.assertRaises(ValueError):
+            scheduler.add_job("never", "0 0 31 2 *", None)
+        self.assertNotIn("never", scheduler.jobs)
+
+
+class JobSchedulerTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.scheduler = main.JobScheduler()
+        self.leader = mock.patch.object(main, 'is_panel_leader', True)
+        self.leader.start()
+
+    def tearDown(self):
+        self.leader.stop()
+
+    async def asyncTearDown(self):
+        if self.scheduler.is_running():
+            self.scheduler._task.cancel()
+            await asyncio.sleep(0)
+
+    async def test_overlapping_run_is_skipped(self):
+        release, calls = asyncio.Event(), []
+        async def slow_job():
+            calls.append(1)
+            await release.wait()
+        self.scheduler.add_job("slow", "* * * * *", slow_job)
+        self.scheduler._dispatch("slow")
+        await asyncio.sleep(0)
+        self.scheduler._dispatch("slow")
+        release.set()
+        await self.scheduler._running["slow"]
+        metrics = self.scheduler.metrics["slow"]
+        self.assertEqual((len(calls), metrics["runs"], metrics["skipped_overlap"]), (1, 1, 1))
+
+    async def test_only_leader_runs_jobs(self):
+        calls = []
+        async def job():
+            calls.append(1)
+        self.scheduler.add_job("job", "* * * * *", job)
+        with mock.patch.object(main, 'is_panel_leader', False):
+            self.scheduler._dispatch("job")
+        self.assertEqual((calls, self.scheduler.metrics["job"]["skipped_not_leader"]), ([], 1))
+        self.assertNotIn("job", self.scheduler._running)
+
+    async def test_failure_is_recorded(self):
+        async def broken():
+            raise RuntimeError("boom")
+        self.scheduler.add_job("broken", "* * * * *", broken)
+        self.scheduler._dispatch("broken")
+        await self.scheduler._running["broken"]
+        metrics = self.scheduler.metrics["broken"]
+        self.assertEqual((metrics["runs"], metrics["failures"], metrics["last_error"]), (1, 1, "RuntimeError: boom"))
+
+    async def test_due_job_runs_and_is_rescheduled(self):
+        done = asyncio.Event()
+        async def job():
+            done.set()
+        self.scheduler.add_job("job", "* * * * *", job)
+        self.scheduler.start()
+        self.scheduler._heap = [(0, "job")] # ถึงเวลาแล้ว
+        await asyncio.wait_for(done.wait(), timeout=2)
+        self.assertEqual([name for _fire_at, name in self.scheduler._heap], ["job"])
+        self.assertGreater(self.scheduler.metrics["job"]["next_run"], datetime.now(main.TZ_BANGKOK))
+
+    async def test_scheduler_restarts_after_crash(self):
+        async def job():
+            pass
+        self.scheduler.add_job("job", "0 0 * * *", job)
+        self.scheduler.start()
+        crashed = self.scheduler._task
+        self.scheduler._heap = [("not a timestamp", "job")] # ทำให้ลูปพังนอก try
+        await asyncio.wait([crashed], timeout=2)
+        await asyncio.sleep(0)
+        self.assertIsNot(self.scheduler._task, crashed)
+        self.assertTrue(self.scheduler.is_running())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+os.environ.setdefault("LOG_LEVEL", "CRITICAL")
+
+import main
+
+
+class CorruptLedgerRowTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.store = main.SharedStateStore(os.path.join(self.tmpdir, "state.db"), "test-instance")
+        self.store.put('team_bank', {"balance": 0, "log": []})
+        self.store.compare_and_swap('team_bank', self.store.get('team_bank')[1], {"balance": 100, "log": []},
+                                    [main.make_ledger_entry(main.BANK_LEDGER_KEY, "ฝาก", 100, 100)])
+        # ทำให้แถวล่าสุดของ ledger เสีย: การต่อ chain ครั้งถัดไปจะ json.loads แถวนี้ไม่ได้
+        self.store._conn.execute("UPDATE ledger_entries SET entry = '{not json' WHERE seq = (SELECT MAX(seq) FROM ledger_entries)")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def bank_write(self, balance):
+        version = self.store.get('team_bank')[1]
+        entries = [main.make_ledger_entry(main.BANK_LEDGER_KEY, "ฝาก", balance - 100, balance)]
+        return self.store.compare_and_swap('team_bank', version, {"balance": balance, "log": []}, entries)
+
+    def test_failed_write_rolls_back(self):
+        version = self.store.get('team_bank')[1]
+        with self.assertRaises(ValueError): # json.JSONDecodeError
+            self.bank_write(150)
+        self.assertFalse(self.store._conn.in_transaction)
+        self.assertEqual(self.store.get('team_bank'), ({"balance": 100, "log": []}, version))
+
+    def test_later_writes_are_not_blocked(self):
+        with self.assertRaises(ValueError):
+            self.bank_write(150)
+        self.store.put('control_panel_message_id', 42) # ไม่มี ledger entry จึงไม่แตะแถวที่เสีย
+        self.assertEqual(self.store.get('control_panel_message_id')[0], 42)
+        other = sqlite3.connect(self.store.path, timeout=0)
+        try:
+            other.execute("BEGIN IMMEDIATE") # write lock ต้องถูกปล่อยแล้ว
+            other.execute("ROLLBACK")
+        finally:
+            other.close()
+
+    def test_open_ledger_rolls_back(self):
+        self.store._conn.execute("DELETE FROM ledger_entries")
+        def broken_opening(*_state):
+            raise KeyError("balance")
+        with self.assertRaises(KeyError):
+            self.store.open_ledger(broken_opening)
+        self.assertFalse(self.store._conn.in_transaction)
+
+
+if __name__ == '__main__':
+    unittest.main()